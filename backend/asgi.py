@@ -0,0 +1,5 @@
+from flaskapp import create_app
+from flaskapp.asgi import AsgiApp
+from flaskapp.config import ProductionConfig
+
+app = AsgiApp(create_app(ProductionConfig))
@@ -2,38 +2,64 @@ import os
 from flask import Flask
 from flask_mail import Mail
 from flask_cors import CORS
-from dotenv import load_dotenv
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 from flaskapp.logging import configure_logging, LogLevels
+from flaskapp.hashing import PasswordHasher
+from flaskapp.replica import RoutingSession
+from flaskapp.metrics import init_metrics
+from flaskapp.timing import init_request_timing
+from flaskapp.pools import configure_engines, configured_max_overflow, watch_pool
 
 
-load_dotenv()
 configure_logging(LogLevels.info)
 
 
 mail = Mail()
-db = SQLAlchemy()
-bcrypt = Bcrypt()
+# reads of read only blueprints can go to a replica, see flaskapp/replica.py
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+hasher = PasswordHasher()
+
+
+def register_pool_watchers(app: Flask):
+    with app.app_context():
+        for key, engine in db.engines.items():
+            watch_pool(engine, key or "default", configured_max_overflow(app, key))
+
+
+# Flask-Migrate imports alembic, only the `flask db` commands need it
+def init_migrate(app: Flask):
+    from flask_migrate import Migrate
+
+    # batch mode lets alembic alter tables on sqlite too
+    Migrate(app, db, render_as_batch=True)
 
 
 def create_app(config_class):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    configure_engines(app)
     db.init_app(app)
+    register_pool_watchers(app)
+    init_metrics(app)
+    init_request_timing(app)
     mail.init_app(app)
-    bcrypt.init_app(app)
+    hasher.init_app(app)
 
     from flaskapp.users.routes import users_bp
     from flaskapp.main.routes import main_bp
     from flaskapp.notes.routes import notes_bp
-    from flaskapp.utils import register_error_handlers
+    from flaskapp.utils import register_error_handlers, init_token_cache
+    from flaskapp.caching import init_local_cache
+    from flaskapp.commands import register_commands
 
     app.register_blueprint(users_bp, url_prefix="/api-v1/users/")
     app.register_blueprint(main_bp, url_prefix="/api-v1/main/")
     app.register_blueprint(notes_bp, url_prefix="/api-v1/notes/")
     register_error_handlers(app)
+    register_commands(app)
+    init_local_cache(app)
+    init_token_cache(app)
 
     # Cross-Origin Resource Sharing
     CORS(app, origins=[os.getenv("ORIGIN", "*")], methods=["GET", "POST"])
@@ -0,0 +1,295 @@
+import io
+import hmac
+import time
+import asyncio
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from flask import Flask, Response
+from pydantic import ValidationError
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from werkzeug.wrappers import Request
+from flaskapp.caching import (
+    RedisKeys,
+    MISSING_ENTRY,
+    count_lookup,
+    create_async_redis,
+    invalidation_listener,
+    local_cache,
+    unpack_entry,
+)
+from flaskapp.exceptions import RateLimitError
+from flaskapp.main import model
+from flaskapp.metrics import start_request_timer
+from flaskapp.pools import warm_up
+from flaskapp.timing import add_timing, start_timing
+from flaskapp.utils import (
+    TOKEN_BUCKET_SCRIPT,
+    cached_json_response,
+    resolve_client_ip,
+)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    # asgiref runs every wsgi call in one shared thread by default, the
+    # flask app is thread safe so requests get a thread of the executor each
+    def __init__(self, wsgi_application, executor: ThreadPoolExecutor):
+        super().__init__(wsgi_application)
+        self.run_wsgi_app = sync_to_async(
+            WsgiToAsgiInstance.__dict__["run_wsgi_app"].func,
+            thread_sensitive=False,
+            executor=executor,
+        )
+
+    async def __call__(self, scope, receive, send):
+        instance = WsgiToAsgiInstance(
+            self.wsgi_application, self.duplicate_header_limit
+        )
+        instance.run_wsgi_app = partial(self.run_wsgi_app, instance)
+        await instance(scope, receive, send)
+
+
+class AsgiApp:
+    """
+    ASGI entry point around the flask app. Cache hits of the public read
+    endpoints are answered on the event loop with an asyncio redis client,
+    every other request (cache misses, errors, writes) runs the flask app in
+    a worker thread, so the services and validation models are shared.
+    There is one thread per database connection of the pool, more could only
+    wait for a connection.
+    """
+
+    def __init__(self, flask_app: Flask):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(
+            max_workers=flask_app.config["DB_POOL_SIZE"]
+            + flask_app.config["DB_MAX_OVERFLOW"],
+            thread_name_prefix="wsgi",
+        )
+        self.wsgi = ThreadedWsgiToAsgi(flask_app, self.executor)
+        self.redis = create_async_redis()
+        self.token_bucket = self.redis.register_script(TOKEN_BUCKET_SCRIPT.script)
+        self.fast_paths = {
+            "main.user_profile": self.user_profile,
+            "main.single_note": self.single_note,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        environ, handler, args = self.match(scope)
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        # only the bodies of the fast path routes are read here
+        body = await self.read_body(receive)
+        request = Request(environ)
+        if body is None:
+            response = self.error(request, RequestEntityTooLarge())
+        else:
+            request.environ["wsgi.input"] = io.BytesIO(body)
+            response = await self.fast_path(request, handler, args)
+            if response is None:
+                return await self.wsgi(scope, replay(body, receive), send)
+
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [
+                    (name.lower().encode("latin1"), value.encode("latin1"))
+                    for name, value in response.headers.items()
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": response.get_data()})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # blocking connects, kept off the event loop
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(
+                    self.executor, invalidation_listener.ensure_started
+                )
+                await loop.run_in_executor(self.executor, warm_up, self.flask_app)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.redis.aclose()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # environ and the fast path handler of a request, no handler for the
+    # routes served by the flask app
+    def match(self, scope) -> tuple:
+        if scope["type"] != "http":
+            return None, None, None
+
+        instance = WsgiToAsgiInstance(None)
+        instance.scope = scope
+        environ = instance.build_environ(scope, io.BytesIO())
+        environ["flaskapp.started"] = time.perf_counter()
+        environ["flaskapp.redis_seconds"] = 0.0
+        try:
+            adapter = self.flask_app.url_map.bind_to_environ(environ)
+            endpoint, args = adapter.match()
+        except HTTPException:
+            return None, None, None
+        return environ, self.fast_paths.get(endpoint), args
+
+    # None once the body is larger than MAX_CONTENT_LENGTH
+    async def read_body(self, receive) -> bytes | None:
+        limit = self.flask_app.config["MAX_CONTENT_LENGTH"]
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if limit is not None and size > limit:
+                return None
+            chunks.append(chunk)
+            more_body = message.get("more_body", False)
+        return b"".join(chunks)
+
+    async def fast_path(self, request: Request, handler, args) -> Response | None:
+        try:
+            return await handler(request, **args)
+        except Exception as e:
+            # the flask app answers, with its own error handling
+            logging.error(f"Async cache read failed. Error: {str(e)}")
+            return None
+
+    async def user_profile(self, request: Request, username: str) -> Response | None:
+        try:
+            validated = model.PublicProfileRequest(username=username)
+        except ValidationError:
+            return None
+
+        key = RedisKeys.user_generation(validated.username)
+        generation = await self.read(request, key)
+        if generation is None:
+            return None
+
+        after = request.args.get("after", "")
+        key = RedisKeys.user_notes(validated.username, int(generation))
+        entry = await self.read(request, key, field=after)
+        if entry is None or entry == MISSING_ENTRY:
+            return None
+
+        _, body, compressed = unpack_entry(entry)
+        return self.respond(request, body, compressed)
+
+    async def single_note(self, request: Request) -> Response | None:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return None
+        try:
+            validated = model.SingleNoteRequest(**data)
+        except ValidationError:
+            return None
+
+        entry = await self.read(request, RedisKeys.single_note(validated.note_id))
+        if entry is None or entry == MISSING_ENTRY:
+            return None
+
+        # a missing or wrong pin is answered by the flask app
+        pin, body, compressed = unpack_entry(entry)
+        if pin and not (
+            validated.pin and hmac.compare_digest(pin, validated.pin.encode())
+        ):
+            return None
+
+        client = resolve_client_ip(
+            request.environ, self.flask_app.config["PROXY_TRUSTED_HOPS"]
+        )
+        wait = await self.rate_limit(request, "single-note", client)
+        if wait:
+            return self.error(request, RateLimitError(retry_after=-(-wait // 1000)))
+        return self.respond(request, body, compressed)
+
+    # same lookup as get_or_set, without computing on a miss
+    async def read(
+        self, request: Request, key: str, field: str | None = None
+    ) -> bytes | None:
+        # started in lifespan, restarted by the flask app on its next miss
+        use_local_cache = invalidation_listener.alive
+        if use_local_cache:
+            value = local_cache.get(key, field)
+            if value is not None:
+                count_lookup(key, True, "local")
+                return value
+
+        generation = local_cache.generation
+        start = time.perf_counter()
+        if field is None:
+            value = await self.redis.get(key)
+        else:
+            value = await self.redis.hget(key, field)
+        request.environ["flaskapp.redis_seconds"] += time.perf_counter() - start
+
+        # a miss is counted by the flask app that handles it
+        if value is not None:
+            count_lookup(key, True)
+            if use_local_cache:
+                local_cache.set(key, value, field=field, generation=generation)
+        return value
+
+    async def rate_limit(self, request: Request, policy: str, client: str) -> int:
+        capacity, rate = self.flask_app.config["RATE_LIMITS"][policy]
+        start = time.perf_counter()
+        try:
+            return await self.token_bucket(
+                keys=[RedisKeys.rate_limit(policy, client)], args=[capacity, rate]
+            )
+        except Exception as e:
+            logging.error(f"Rate limit check failed. Error: {str(e)}")
+            return 0
+        finally:
+            request.environ["flaskapp.redis_seconds"] += time.perf_counter() - start
+
+    # the before_request hooks of the metrics and the request timing, the
+    # request is timed from the start of the fast path
+    def start_request(self, request: Request) -> None:
+        started = request.environ["flaskapp.started"]
+        start_request_timer(started)
+        if self.flask_app.config["REQUEST_TIMING"]:
+            start_timing(started)
+            # zero when answered from the local cache
+            if request.environ["flaskapp.redis_seconds"]:
+                add_timing("redis", request.environ["flaskapp.redis_seconds"])
+
+    # response built by flask, after_request handlers (cors, metrics) included
+    def respond(self, request: Request, body: bytes, compressed: bool) -> Response:
+        with self.flask_app.request_context(request.environ):
+            self.start_request(request)
+            response = cached_json_response(body, compressed)
+            return self.flask_app.process_response(response)
+
+    def error(self, request: Request, e: HTTPException) -> Response:
+        with self.flask_app.request_context(request.environ):
+            self.start_request(request)
+            response = self.flask_app.make_response(
+                self.flask_app.handle_user_exception(e)
+            )
+            return self.flask_app.process_response(response)
+
+
+# hand the already read body to the wsgi adapter again
+def replay(body: bytes, receive):
+    sent = False
+
+    async def inner():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return inner
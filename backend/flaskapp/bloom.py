@@ -0,0 +1,102 @@
+import math
+import hashlib
+import logging
+from flaskapp import db
+from flaskapp.caching import redis_client, RedisKeys
+from flaskapp.config import Config
+from flaskapp.db_models import User
+
+# bits are only set while the filter exists, a partial filter created by an
+# add on a flushed redis would report taken names as available. The filter
+# being rebuilt gets the bits too so no registration is missed meanwhile.
+ADD_SCRIPT = redis_client.register_script(
+    """
+    for _, key in ipairs(KEYS) do
+        if redis.call("EXISTS", key) == 1 then
+            for _, bit in ipairs(ARGV) do
+                redis.call("SETBIT", key, bit, 1)
+            end
+        end
+    end
+    return 0
+    """
+)
+
+
+class BloomFilter:
+    """
+    Bloom filter stored as a redis bitmap. might_contain never returns a
+    false negative, a missing filter answers True so callers fall back to
+    the database.
+    """
+
+    def __init__(self, key: str, capacity: int, error_rate: float):
+        self.key = key
+        self.building_key = f"{key}:building"
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+
+    # double hashing, k positions from the two halves of one digest
+    def positions(self, item: str) -> list:
+        digest = hashlib.sha256(item.encode("utf-8")).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def might_contain(self, item: str) -> bool:
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.exists(self.key)
+            for position in self.positions(item):
+                pipe.getbit(self.key, position)
+            exists, *bits = pipe.execute()
+        except Exception as e:
+            logging.error(f"Bloom filter check failed. Error: {str(e)}")
+            return True
+        return not exists or all(bits)
+
+    def add(self, *items: str) -> None:
+        bits = [position for item in items for position in self.positions(item)]
+        try:
+            ADD_SCRIPT(keys=[self.key, self.building_key], args=bits)
+        except Exception as e:
+            # the item is then missing from the filter, rebuild it
+            logging.error(f"Failed to add to bloom filter. Error: {str(e)}")
+
+    def rebuild(self, items) -> int:
+        # create the new bitmap first, registrations from now on are added to it
+        redis_client.delete(self.building_key)
+        redis_client.setbit(self.building_key, self.size - 1, 0)
+
+        count = 0
+        pipe = redis_client.pipeline(transaction=False)
+        for item in items:
+            for position in self.positions(item):
+                pipe.setbit(self.building_key, position, 1)
+            count += 1
+            if count % 1000 == 0:
+                pipe.execute()
+        pipe.execute()
+
+        redis_client.rename(self.building_key, self.key)
+        return count
+
+
+user_filter = BloomFilter(
+    RedisKeys.USER_FILTER, Config.USER_FILTER_CAPACITY, Config.USER_FILTER_ERROR_RATE
+)
+
+
+def name_item(username: str) -> str:
+    return "name:" + username.strip().replace(" ", "-").lower()
+
+
+def email_item(email: str) -> str:
+    return f"email:{email}"
+
+
+def rebuild_user_filter() -> int:
+    rows = db.session.query(User.username, User.email).yield_per(1000)
+    return user_filter.rebuild(
+        item for row in rows for item in (name_item(row.username), email_item(row.email))
+    )
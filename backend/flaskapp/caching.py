@@ -1,22 +1,61 @@
 import os
+import gzip
+import json
+import math
+import time
+import uuid
 import redis
-from dotenv import load_dotenv
+import random
+import logging
+import threading
+from collections import OrderedDict
+from flask import Flask, current_app, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from flaskapp.config import Config
+from flaskapp.metrics import CACHE_HITS, CACHE_MISSES, CACHE_EVICTIONS
 
-load_dotenv()
-
-REDIS_URI = os.getenv("REDIS_URI")
+REDIS_URI = Config.REDIS_URI
 
+# no connection is opened here, the pools connect on the first command
 redis_client = redis.Redis.from_url(REDIS_URI, decode_responses=True)
 
+# cached response bodies are stored and served as raw bytes
+redis_bytes_client = redis.Redis.from_url(REDIS_URI)
+
+
+# asyncio client for the ASGI entry point, its connections belong to the
+# event loop that first uses them, so every ASGI app creates its own
+def create_async_redis() -> "redis.asyncio.Redis":
+    import redis.asyncio
+
+    return redis.asyncio.Redis.from_url(REDIS_URI)
+
 
 class RedisKeys:
     SIGN_UP = "signup:{email}:otp"
     RESET_PASSWORD = "reset_pass:{email}:otp"
-    USER_NOTES = "user:{username}:notes"
+    USER_GENERATION = "user:{username}:gen"
+    USER_NOTES = "user:{username}:notes:{generation}"
     SINGLE_NOTE = "note:{note_id}"
     TOTAL_USER = "total_user"
     TOTAL_NOTE = "total_note"
     TOTAL_CHAR = "total_char"
+    INVALIDATION_CHANNEL = "cache:invalidate"
+    LOCK = "lock:{key}"
+    PRINCIPAL = "principal:{user_id}"
+    OTP_IP_WINDOW = "otp:ip:{ip}"
+    OTP_EMAIL_WINDOW = "otp:email:{email}"
+    RATE_LIMIT = "rate:{policy}:{client}"
+    STICKY_USER = "sticky:user:{username}"
+    STICKY_NOTE = "sticky:note:{note_id}"
+    USER_FILTER = "bloom:users"
+    MAIL_QUEUE = "mail:queue"
+    MAIL_PROCESSING = "mail:processing:{worker_id}"
+    MAIL_WORKER = "mail:worker:{worker_id}"
+    MAIL_WORKERS = "mail:workers"
+    MAIL_RETRY = "mail:retry"
+    MAIL_FAILED = "mail:failed"
 
     @classmethod
     def sign_up(cls, email: str) -> str:
@@ -27,9 +66,549 @@ class RedisKeys:
         return cls.RESET_PASSWORD.format(email=email)
 
     @classmethod
-    def user_notes(cls, username: str) -> str:
-        return cls.USER_NOTES.format(username=username)
+    def user_generation(cls, username: str) -> str:
+        return cls.USER_GENERATION.format(username=username)
+
+    # versioned by the user's generation, see bump_generation
+    @classmethod
+    def user_notes(cls, username: str, generation: int) -> str:
+        return cls.USER_NOTES.format(username=username, generation=generation)
 
     @classmethod
-    def single_note(cls, note_id: str) -> str:
+    def single_note(cls, note_id: int) -> str:
         return cls.SINGLE_NOTE.format(note_id=note_id)
+
+    @classmethod
+    def principal(cls, user_id: int) -> str:
+        return cls.PRINCIPAL.format(user_id=user_id)
+
+    @classmethod
+    def otp_ip_window(cls, ip: str) -> str:
+        return cls.OTP_IP_WINDOW.format(ip=ip)
+
+    @classmethod
+    def otp_email_window(cls, email: str) -> str:
+        return cls.OTP_EMAIL_WINDOW.format(email=email)
+
+    @classmethod
+    def sticky_user(cls, username: str) -> str:
+        return cls.STICKY_USER.format(username=username)
+
+    @classmethod
+    def sticky_note(cls, note_id: int) -> str:
+        return cls.STICKY_NOTE.format(note_id=note_id)
+
+    # jobs a mail worker is sending, moved back to the queue if it dies
+    @classmethod
+    def mail_processing(cls, worker_id: str) -> str:
+        return cls.MAIL_PROCESSING.format(worker_id=worker_id)
+
+    # heartbeat of a running mail worker
+    @classmethod
+    def mail_worker(cls, worker_id: str) -> str:
+        return cls.MAIL_WORKER.format(worker_id=worker_id)
+
+    @classmethod
+    def rate_limit(cls, policy: str, client: str) -> str:
+        return cls.RATE_LIMIT.format(policy=policy, client=client)
+
+    @classmethod
+    def lock(cls, key: str) -> str:
+        return cls.LOCK.format(key=key)
+
+    # metric label of a key, the kind of data it caches
+    @classmethod
+    def family(cls, key: str) -> str:
+        if key.startswith(cls.SINGLE_NOTE.partition("{")[0]):
+            return "note"
+        if key.startswith(cls.USER_NOTES.partition("{")[0]):
+            return "user_generation" if key.endswith(":gen") else "user_notes"
+        if key in (cls.TOTAL_USER, cls.TOTAL_NOTE, cls.TOTAL_CHAR):
+            return "totals"
+        if key.startswith(
+            (cls.SIGN_UP.partition("{")[0], cls.RESET_PASSWORD.partition("{")[0])
+        ):
+            return "otp"
+        if key.startswith(cls.PRINCIPAL.partition("{")[0]):
+            return "principal"
+        return "other"
+
+
+# hit and miss counts per key family, exported on /metrics
+def count_lookup(key: str, hit: bool, layer: str = "redis") -> None:
+    if hit:
+        CACHE_HITS.labels(RedisKeys.family(key), layer).inc()
+    else:
+        CACHE_MISSES.labels(RedisKeys.family(key)).inc()
+
+
+class LocalCache:
+    """
+    In-process LRU cache with a per entry TTL, bounded by entry count and
+    by the total size of the stored values.
+    Entries can be fields of a key, deleting the key drops all its fields.
+    """
+
+    def __init__(
+        self, max_items: int, max_bytes: int, ttl: int, family: str | None = None
+    ):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        # bumped on every invalidation, lets a reader detect that the value
+        # it fetched from redis may already be stale before storing it
+        self.generation = 0
+        self._data = OrderedDict()
+        self._fields = {}
+        self._lock = threading.Lock()
+        # eviction metric label, by default the family of the evicted key
+        self.family = family
+
+    # limits are set again from the app config once the app is created
+    def configure(self, max_items: int, max_bytes: int, ttl: int) -> None:
+        with self._lock:
+            self.max_items = max_items
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+        self.clear()
+
+    def get(self, key: str, field: str | None = None):
+        with self._lock:
+            entry = self._data.get((key, field))
+            if entry is None:
+                return None
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                self._pop((key, field))
+                return None
+
+            self._data.move_to_end((key, field))
+            return value
+
+    def set(
+        self,
+        key: str,
+        value,
+        field: str | None = None,
+        generation: int | None = None,
+    ) -> None:
+        value_size = len(value)
+        if value_size > self.max_bytes:
+            return
+
+        with self._lock:
+            # an invalidation happened while the value was being loaded
+            if generation is not None and generation != self.generation:
+                return
+
+            self._pop((key, field))
+            self._data[(key, field)] = (value, time.monotonic() + self.ttl)
+            self._fields.setdefault(key, set()).add(field)
+            self.size += value_size
+
+            # evict least recently used entries
+            while len(self._data) > self.max_items or self.size > self.max_bytes:
+                oldest_entry = next(iter(self._data))
+                self._pop(oldest_entry)
+                family = self.family or RedisKeys.family(oldest_entry[0])
+                CACHE_EVICTIONS.labels(family).inc()
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                for field in self._fields.get(key, set()).copy():
+                    self._pop((key, field))
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self._fields.clear()
+            self.size = 0
+
+    def _pop(self, entry_key: tuple) -> None:
+        entry = self._data.pop(entry_key, None)
+        if entry is None:
+            return
+
+        self.size -= len(entry[0])
+        key, field = entry_key
+        fields = self._fields[key]
+        fields.discard(field)
+        if not fields:
+            del self._fields[key]
+
+
+local_cache = LocalCache(
+    max_items=Config.L1_CACHE_MAX_ITEMS,
+    max_bytes=Config.L1_CACHE_MAX_BYTES,
+    ttl=Config.L1_CACHE_TTL,
+)
+
+
+def init_local_cache(app: Flask) -> None:
+    local_cache.configure(
+        app.config["L1_CACHE_MAX_ITEMS"],
+        app.config["L1_CACHE_MAX_BYTES"],
+        app.config["L1_CACHE_TTL"],
+    )
+
+
+class InvalidationListener:
+    """
+    Subscribes to the invalidation channel so every worker process drops keys
+    that were changed by any other worker or node.
+    The listener is started lazily per process, so it survives gunicorn forks.
+    """
+
+    def __init__(self, cache: LocalCache):
+        self.cache = cache
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return (
+            self._pid == os.getpid()
+            and self._thread is not None
+            and self._thread.is_alive()
+        )
+
+    def ensure_started(self) -> bool:
+        if self.alive:
+            return True
+
+        with self._lock:
+            if self.alive:
+                return True
+
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(
+                    **{RedisKeys.INVALIDATION_CHANNEL: self._handle_message}
+                )
+                self._thread = pubsub.run_in_thread(
+                    sleep_time=1,
+                    daemon=True,
+                    exception_handler=self._handle_error,
+                )
+                self._pid = os.getpid()
+            except Exception as e:
+                logging.error(f"Failed to start cache invalidation listener. Error: {e}")
+                return False
+
+        return True
+
+    def _handle_message(self, message) -> None:
+        self.cache.delete(*json.loads(message["data"]))
+
+    def _handle_error(self, e, pubsub, thread) -> None:
+        # without invalidation messages the local cache can not be trusted
+        logging.error(f"Cache invalidation listener stopped. Error: {e}")
+        self.cache.clear()
+        thread.stop()
+        pubsub.close()
+
+
+invalidation_listener = InvalidationListener(local_cache)
+
+
+_PENDING_KEYS = "cache_invalidate_keys"
+_PENDING_GENERATIONS = "cache_generations"
+_PENDING_COMMANDS = "cache_commands"
+
+# a generation counter versions every cached key derived from one owner, a
+# single INCR makes all of them unreachable and they expire by their ttl.
+# A lost or expired counter restarts from the current time, never from a
+# number whose keys may still be cached.
+GET_GENERATION_SCRIPT = redis_client.register_script(
+    """
+    local generation = redis.call("GET", KEYS[1])
+    if generation then
+        return tonumber(generation)
+    end
+    redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+    return tonumber(ARGV[1])
+    """
+)
+BUMP_GENERATION_SCRIPT = redis_client.register_script(
+    """
+    if redis.call("EXISTS", KEYS[1]) == 1 then
+        local generation = redis.call("INCR", KEYS[1])
+        redis.call("EXPIRE", KEYS[1], ARGV[2])
+        return generation
+    end
+    redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+    return tonumber(ARGV[1])
+    """
+)
+
+
+# current generation, read through the local cache like any cached value
+def get_generation(key: str) -> int:
+    use_local_cache = invalidation_listener.ensure_started()
+    if use_local_cache:
+        value = local_cache.get(key)
+        if value is not None:
+            count_lookup(key, True, "local")
+            return int(value)
+
+    # the script creates a missing counter, every read is a redis hit
+    count_lookup(key, True)
+    generation = local_cache.generation
+    value = GET_GENERATION_SCRIPT(
+        keys=[key],
+        args=[time.time_ns() // 1000, current_app.config["CACHE_GENERATION_TTL"]],
+    )
+    if use_local_cache:
+        local_cache.set(key, str(value).encode(), generation=generation)
+    return value
+
+
+# drop keys once the session commits, all keys of a transaction are
+# deleted and published to the other workers in one round trip
+def invalidate(session, *keys: str) -> None:
+    session.info.setdefault(_PENDING_KEYS, set()).update(keys)
+
+
+# move a generation counter forward once the session commits
+def bump_generation(session, *keys: str) -> None:
+    session.info.setdefault(_PENDING_GENERATIONS, set()).update(keys)
+
+
+# run a redis command in the same pipeline after the session commits,
+# command is called with the pipeline, e.g. a counter update
+def on_commit(session, command) -> None:
+    session.info.setdefault(_PENDING_COMMANDS, []).append(command)
+
+
+@event.listens_for(Session, "after_commit")
+def _flush_pending(session) -> None:
+    keys = sorted(session.info.pop(_PENDING_KEYS, ()))
+    generations = sorted(session.info.pop(_PENDING_GENERATIONS, ()))
+    commands = session.info.pop(_PENDING_COMMANDS, [])
+    if not keys and not generations and not commands:
+        return
+
+    local_cache.delete(*keys, *generations)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        if keys:
+            pipe.unlink(*keys)
+        for key in generations:
+            pipe.eval(
+                BUMP_GENERATION_SCRIPT.script,
+                1,
+                key,
+                time.time_ns() // 1000,
+                current_app.config["CACHE_GENERATION_TTL"],
+            )
+        if keys or generations:
+            pipe.publish(
+                RedisKeys.INVALIDATION_CHANNEL, json.dumps([*keys, *generations])
+            )
+        for command in commands:
+            command(pipe)
+        pipe.execute()
+    except Exception as e:
+        # the data is committed, the cached copies expire with their ttl
+        logging.error(f"Failed to flush cache invalidation keys={keys}. Error: {e}")
+
+
+# nothing changed, nothing to invalidate
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_pending(session, previous_transaction) -> None:
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING_KEYS, None)
+        session.info.pop(_PENDING_GENERATIONS, None)
+        session.info.pop(_PENDING_COMMANDS, None)
+
+
+# delete the lock only if it is still owned by the caller
+RELEASE_LOCK_SCRIPT = redis_client.register_script(
+    """
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("DEL", KEYS[1])
+    end
+    return 0
+    """
+)
+
+# last measured recompute time per key, used for probabilistic early refresh
+_recompute_seconds = {}
+
+
+def jittered_ttl(ttl: int) -> int:
+    jitter = ttl * current_app.config["CACHE_TTL_JITTER"]
+    return max(1, round(ttl + random.uniform(-jitter, jitter)))
+
+
+# XFetch: the closer the key is to expiry, the more likely a reader refreshes it
+def should_refresh_early(key: str, remaining_ms: int) -> bool:
+    if remaining_ms < 0:
+        return False
+
+    delta = _recompute_seconds.get(key, 0.1)
+    beta = current_app.config["CACHE_EARLY_REFRESH_BETA"]
+    gap = -delta * beta * math.log(1 - random.random())
+    return gap * 1000 >= remaining_ms
+
+
+# store a field of a hash key, unless the hash already holds max_fields fields
+STORE_FIELD_SCRIPT = redis_bytes_client.register_script(
+    """
+    local max_fields = tonumber(ARGV[4])
+    if max_fields > 0 and redis.call("HEXISTS", KEYS[1], ARGV[1]) == 0
+        and redis.call("HLEN", KEYS[1]) >= max_fields then
+        return 0
+    end
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+    if tonumber(ARGV[3]) > 0 then
+        redis.call("EXPIRE", KEYS[1], ARGV[3])
+    end
+    return 1
+    """
+)
+
+
+def _read(key: str, field: str | None) -> bytes | None:
+    if field is None:
+        return redis_bytes_client.get(key)
+    return redis_bytes_client.hget(key, field)
+
+
+def _compute_and_store(
+    key: str, compute, ttl: int | None, field: str | None, max_fields: int
+) -> bytes:
+    started = time.monotonic()
+    value = compute()
+
+    if len(_recompute_seconds) > 1024:
+        _recompute_seconds.clear()
+    _recompute_seconds[key] = time.monotonic() - started
+
+    # a cached miss lives shorter, the row may be created soon
+    if value == MISSING_ENTRY:
+        ttl = current_app.config["NEGATIVE_CACHE_TTL"]
+    # a replica read can predate a write whose sticky window just ended
+    if has_request_context() and g.get("read_replica", False):
+        replica_ttl = current_app.config["REPLICA_CACHE_TTL"]
+        ttl = min(ttl, replica_ttl) if ttl else replica_ttl
+    ex = jittered_ttl(ttl) if ttl else None
+    if field is None:
+        redis_bytes_client.set(key, value, ex=ex)
+    else:
+        STORE_FIELD_SCRIPT(keys=[key], args=[field, value, ex or 0, max_fields])
+    return value
+
+
+def _recompute(
+    key: str,
+    compute,
+    ttl: int | None,
+    field: str | None = None,
+    max_fields: int = 0,
+    stale=None,
+) -> bytes:
+    """
+    Single-flight recompute: only the lock owner runs compute, the other
+    requests serve the stale value or wait until the owner stored a new one.
+    """
+
+    lock_key = RedisKeys.lock(key if field is None else f"{key}:{field}")
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + current_app.config["CACHE_LOCK_WAIT"]
+    lease = current_app.config["CACHE_LOCK_LEASE"]
+
+    while True:
+        if redis_client.set(lock_key, token, nx=True, px=lease):
+            try:
+                return _compute_and_store(key, compute, ttl, field, max_fields)
+            finally:
+                RELEASE_LOCK_SCRIPT(keys=[lock_key], args=[token])
+
+        if stale is not None:
+            return stale
+
+        time.sleep(0.05)
+        value = _read(key, field)
+        if value is not None:
+            return value
+
+        # the lock owner is too slow or died, stop waiting
+        if time.monotonic() > deadline:
+            logging.warning(f"Timed out waiting for cache lock key={lock_key}")
+            return _compute_and_store(key, compute, ttl, field, max_fields)
+
+
+def get_or_set(
+    key: str,
+    compute,
+    ttl: int | None = None,
+    field: str | None = None,
+    max_fields: int = 0,
+) -> bytes:
+    """
+    Read a key, or a field of a hash key, through the local cache and redis.
+    On a miss exactly one request across all workers runs compute, plain
+    keys with a ttl are refreshed a little before they expire.
+    A hash key stops caching new fields once it holds max_fields fields.
+    """
+
+    use_local_cache = invalidation_listener.ensure_started()
+    if use_local_cache:
+        value = local_cache.get(key, field)
+        if value is not None:
+            count_lookup(key, True, "local")
+            return value
+
+    generation = local_cache.generation
+    if ttl and field is None:
+        pipe = redis_bytes_client.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        value, remaining_ms = pipe.execute()
+        if value is not None and should_refresh_early(key, remaining_ms):
+            count_lookup(key, True)
+            return _recompute(key, compute, ttl, stale=value)
+    else:
+        value = _read(key, field)
+
+    count_lookup(key, value is not None)
+    if value is None:
+        value = _recompute(key, compute, ttl, field, max_fields)
+
+    if use_local_cache:
+        local_cache.set(key, value, field=field, generation=generation)
+    return value
+
+
+# a cache entry is the final response body, prefixed by a flags byte and a
+# small metadata value that is checked before the body is served (e.g. a
+# note pin). Large bodies are stored gzip compressed, ready to be sent to
+# clients that accept gzip.
+ENTRY_GZIP = 0x01
+ENTRY_MISSING = 0x02
+
+# stored when the database has no row for the key, so repeated lookups of
+# ids or names that do not exist are answered from the cache
+MISSING_ENTRY = bytes([ENTRY_MISSING, 0])
+
+
+def pack_entry(body: bytes, meta: bytes = b"") -> bytes:
+    flags = 0
+    if len(body) >= current_app.config["CACHE_COMPRESS_MIN_BYTES"]:
+        level = current_app.config["CACHE_COMPRESS_LEVEL"]
+        body = gzip.compress(body, compresslevel=level, mtime=0)
+        flags |= ENTRY_GZIP
+    return bytes([flags, len(meta)]) + meta + body
+
+
+def unpack_entry(entry: bytes) -> tuple[bytes, bytes, bool]:
+    flags = entry[0]
+    meta_end = entry[1] + 2
+    return entry[2:meta_end], entry[meta_end:], bool(flags & ENTRY_GZIP)
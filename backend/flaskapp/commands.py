@@ -0,0 +1,46 @@
+import click
+from flask import Flask
+
+
+# flask cli commands, e.g. `flask --app wsgi reconcile-counters`
+def register_commands(app: Flask):
+    app.cli.add_command(MigrateCommand("db", help="Perform database migrations."))
+
+    @app.cli.command("reconcile-counters")
+    def reconcile_counters_command():
+        """Recount the homepage counters from the database."""
+        from flaskapp.counters import reconcile_counters
+
+        counters = reconcile_counters()
+        for key, value in counters.items():
+            click.echo(f"{key}: {value}")
+
+    @app.cli.command("mail-worker")
+    def mail_worker_command():
+        """Send queued emails until interrupted."""
+        from flaskapp.mailer import MailWorker
+
+        click.echo("Mail worker started")
+        MailWorker().run()
+
+    @app.cli.command("rebuild-user-filter")
+    def rebuild_user_filter_command():
+        """Rebuild the bloom filter of taken usernames and emails."""
+        from flaskapp.bloom import rebuild_user_filter
+
+        click.echo(f"Added {rebuild_user_filter()} usernames and emails")
+
+
+class MigrateCommand(click.Command):
+    """
+    `flask db` of Flask-Migrate, alembic is imported when a database command
+    runs instead of in every process that creates the app.
+    """
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        from flask.cli import ScriptInfo
+        from flask_migrate.cli import db as db_cli_group
+        from flaskapp import init_migrate
+
+        init_migrate(parent.ensure_object(ScriptInfo).load_app())
+        return db_cli_group.make_context(info_name, args, parent=parent, **extra)
@@ -1,6 +1,7 @@
 import os
 from dotenv import load_dotenv
 
+# the only place .env is read, every module gets settings from Config
 load_dotenv()
 
 
@@ -8,6 +9,29 @@ class Config:
     SECRET_KEY = os.getenv("SECRET_KEY")
     AUTH_PREFIX = os.getenv("AUTH_PREFIX")
     SQLALCHEMY_DATABASE_URI = os.getenv("SQLALCHEMY_DATABASE_URI")
+    MAX_CONTENT_LENGTH = 256 * 1024  # bytes of a request body, 413 above
+
+    # connection pool of every worker process, applied to the replica too,
+    # see pools.engine_options. One connection per gunicorn request thread,
+    # gunicorn.conf.py keeps all workers together below DB_MAX_CONNECTIONS
+    # (postgres max_connections).
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", os.getenv("GUNICORN_THREADS", 4)))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 2))
+    DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", 100))
+    DB_POOL_TIMEOUT = 10  # seconds waiting for a free connection
+    DB_POOL_RECYCLE = 30 * 60  # seconds
+    DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", 10000))  # ms
+    SQLALCHEMY_ENGINE_OPTIONS = {}  # override the options of the primary
+
+    # optional read replica for the public main blueprint
+    SQLALCHEMY_REPLICA_URI = os.getenv("SQLALCHEMY_REPLICA_URI")
+    SQLALCHEMY_BINDS = (
+        {"replica": SQLALCHEMY_REPLICA_URI} if SQLALCHEMY_REPLICA_URI else {}
+    )
+    REPLICA_MAX_LAG = 5  # seconds, read from primary when the replica is behind
+    REPLICA_LAG_CHECK_INTERVAL = 5  # seconds
+    REPLICA_STICKY_SECONDS = 10  # read your writes window after a write
+    REPLICA_CACHE_TTL = 30  # seconds, cached values read from the replica
 
     # MAIL_SERVER configuration
     MAIL_SERVER = "smtp.gmail.com"
@@ -17,17 +41,59 @@ class Config:
     MAIL_USE_TLS = False
     MAIL_USE_SSL = True
 
+    # outbound mail queue, drained by the mail-worker command
+    MAIL_BATCH_SIZE = 50  # jobs sent per batch over one connection
+    MAIL_MAX_ATTEMPTS = 5
+    MAIL_RETRY_BACKOFF = 5  # seconds, doubled on every failed attempt
+    MAIL_POLL_TIMEOUT = 1  # seconds
+    MAIL_IDLE_TIMEOUT = 60  # seconds before an unused connection is closed
+    MAIL_WORKER_TTL = 60  # seconds without a heartbeat before a worker is dead
+
     # jwt
     JWT_TIMEOUT_MINUTES = int(os.getenv("JWT_TIMEOUT_MINUTES"))
+    PRINCIPAL_CACHE_TTL = 60  # seconds
+    PRINCIPAL_CACHE_MAX_ITEMS = 10000
+
+    # password hashing
+    BCRYPT_LOG_ROUNDS = int(os.getenv("BCRYPT_LOG_ROUNDS", 13))
+    # processes per app process, every gunicorn worker starts its own pool
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 1))
+    PASSWORD_HASH_TIMEOUT = 10  # seconds
+    # a cost 13 hash takes about 0.7s of one core, every cost step doubles it.
+    # More queued hashes than finish within the timeout are rejected with 503.
+    PASSWORD_HASH_SECONDS = 0.7 * 2 ** (BCRYPT_LOG_ROUNDS - 13)
+    PASSWORD_HASH_MAX_PENDING = max(
+        int(PASSWORD_HASH_WORKERS * PASSWORD_HASH_TIMEOUT / PASSWORD_HASH_SECONDS), 1
+    )
 
     # user
     MAX_NAME_LENGTH = 20
     MIN_NAME_LENGTH = 3
     OTP_LENGTH = 6
+    OTP_TTL = 60 * 2  # seconds
+    OTP_WINDOW = 60 * 60  # seconds, sliding window for the limits below
+    OTP_MAX_PER_IP = 20
+    OTP_MAX_PER_EMAIL = 5
     MIN_PASS_LENGTH = 8
     MAX_PASS_LENGTH = 20
     PASSWORD_REGEX = r"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)[a-zA-Z\d]{8,20}$"
 
+    # bloom filter of taken usernames and emails, about 1.2MB in redis
+    USER_FILTER_CAPACITY = 1_000_000
+    USER_FILTER_ERROR_RATE = 0.01
+
+    # reverse proxies in front of the app (nginx), the client ip of the rate
+    # limits is read from X-Forwarded-For. Only set it when every request
+    # comes through them, a client reaching the app directly picks its own ip.
+    PROXY_TRUSTED_HOPS = int(os.getenv("PROXY_TRUSTED_HOPS", 0))
+
+    # rate limits per client ip, token bucket of (capacity, tokens per second)
+    RATE_LIMITS = {
+        "log-in": (10, 10 / 60),
+        "sign-up": (5, 5 / 60),
+        "single-note": (30, 1),
+    }
+
     # note
     MAX_NOTE_ID_LENGTH = 7
     MIN_TITLE_LENGTH = 1
@@ -37,6 +103,42 @@ class Config:
     MIN_PIN_LENGTH = 3
     MAX_PIN_LENGTH = 8
 
+    # public profile
+    PROFILE_NOTES_PER_PAGE = 20
+    PROFILE_CACHE_MAX_PAGES = 50  # cached pages per user
+    PROFILE_CACHE_TTL = 60 * 60 * 24  # seconds
+
+    # per request phase timing, Server-Timing header and histograms
+    REQUEST_TIMING = os.getenv("REQUEST_TIMING", "0") == "1"
+
+    # bearer token of GET /metrics, the endpoint is disabled without it
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+    # redis
+    REDIS_URI = os.getenv("REDIS_URI")
+
+    # in-process cache in front of redis
+    L1_CACHE_MAX_ITEMS = int(os.getenv("L1_CACHE_MAX_ITEMS", 1024))
+    L1_CACHE_MAX_BYTES = int(os.getenv("L1_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+    L1_CACHE_TTL = int(os.getenv("L1_CACHE_TTL", 30))  # seconds
+
+    # cache stampede protection
+    CACHE_LOCK_LEASE = 5000  # milliseconds
+    CACHE_LOCK_WAIT = 3  # seconds
+    COUNTER_RECONCILE_LEASE = 60 * 1000  # milliseconds, one recount at a time
+    CACHE_TTL_JITTER = 0.1
+    CACHE_EARLY_REFRESH_BETA = 1.0
+
+    # generation counters outlive every key they version (profile pages)
+    CACHE_GENERATION_TTL = PROFILE_CACHE_TTL * 2  # seconds
+
+    # cached response bodies from this size on are stored gzip compressed
+    CACHE_COMPRESS_MIN_BYTES = 1024
+    CACHE_COMPRESS_LEVEL = 6
+
+    # not found results (unknown note id or username)
+    NEGATIVE_CACHE_TTL = 30  # seconds
+
 
 class DevelopmentConfig(Config):
     DEBUG = True
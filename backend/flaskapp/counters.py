@@ -0,0 +1,108 @@
+import uuid
+import logging
+import threading
+from flask import current_app
+from sqlalchemy import func
+from flaskapp import db
+from flaskapp.caching import (
+    redis_client,
+    RedisKeys,
+    RELEASE_LOCK_SCRIPT,
+    count_lookup,
+    on_commit,
+)
+from flaskapp.db_models import User, Notes
+
+COUNTER_KEYS = [RedisKeys.TOTAL_USER, RedisKeys.TOTAL_NOTE, RedisKeys.TOTAL_CHAR]
+
+# a missing counter is never created by an increment, it would start from 0
+# instead it is rebuilt from the database by reconcile_counters
+INCR_IF_EXISTS_SCRIPT = redis_client.register_script(
+    """
+    for i, key in ipairs(KEYS) do
+        if redis.call("EXISTS", key) == 1 then
+            redis.call("INCRBY", key, ARGV[i])
+        end
+    end
+    return 0
+    """
+)
+
+
+# apply a change to the homepage counters once the session commits, sent
+# in the same pipeline as the cache invalidation of the write
+def update_counters(users: int = 0, notes: int = 0, chars: int = 0) -> None:
+    # plain EVAL, a Script object would add a SCRIPT EXISTS round trip to
+    # the pipeline. A failed update is fixed by the periodic reconciliation.
+    on_commit(
+        db.session,
+        lambda pipe: pipe.eval(
+            INCR_IF_EXISTS_SCRIPT.script,
+            len(COUNTER_KEYS),
+            *COUNTER_KEYS,
+            users,
+            notes,
+            chars,
+        ),
+    )
+
+
+# recount everything from the database, this is a full table scan
+def reconcile_counters() -> dict:
+    counters = {
+        RedisKeys.TOTAL_USER: User.query.count(),
+        RedisKeys.TOTAL_NOTE: Notes.query.count(),
+        RedisKeys.TOTAL_CHAR: (
+            db.session.query(
+                func.sum(func.length(Notes.title) + func.length(Notes.text))
+            ).scalar()
+        )
+        or 0,
+    }
+    redis_client.mset(counters)
+    return counters
+
+
+# last values read by this process, served while the counters are rebuilt
+_last_counters = dict.fromkeys(COUNTER_KEYS, 0)
+
+
+def read_counters() -> dict:
+    values = redis_client.mget(COUNTER_KEYS)
+    count_lookup(RedisKeys.TOTAL_USER, None not in values)
+    if None not in values:
+        _last_counters.update(zip(COUNTER_KEYS, map(int, values)))
+    else:
+        # counters are lost (first boot or redis flushed), never scan the
+        # tables on the request path
+        start_reconcile()
+    return dict(_last_counters)
+
+
+# one process of the cluster recounts in a background thread, the others
+# keep serving the last known values until the counters are back
+def start_reconcile() -> threading.Thread | None:
+    lock_key = RedisKeys.lock("counters")
+    token = uuid.uuid4().hex
+    if not redis_client.set(
+        lock_key, token, nx=True, px=current_app.config["COUNTER_RECONCILE_LEASE"]
+    ):
+        return None
+
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            try:
+                reconcile_counters()
+            except Exception as e:
+                # retried by a request once the lease expires, or by the job
+                logging.error(f"Failed to reconcile homepage counters. Error: {e}")
+                return
+            finally:
+                db.session.remove()
+            RELEASE_LOCK_SCRIPT(keys=[lock_key], args=[token])
+
+    thread = threading.Thread(target=run, name="reconcile-counters", daemon=True)
+    thread.start()
+    return thread
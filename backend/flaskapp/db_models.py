@@ -40,5 +40,15 @@ class Notes(db.Model):
     date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
 
+    # a user's notes newest first, serves note lists and keyset pagination
+    __table_args__ = (
+        db.Index(
+            "ix_notes_user_id_date_created_id",
+            user_id,
+            date_created.desc(),
+            id.desc(),
+        ),
+    )
+
     def __repr__(self):
         return f"id: {self.id} | Title: {self.title} | Author: {self.user_id}"
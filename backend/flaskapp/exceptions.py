@@ -49,6 +49,11 @@ class InternalServerError(ServerError):
         super().__init__(description=detail)
 
 
+class ServiceUnavailableError(ServerError):
+    code = 503
+    description = "Server is busy, please try again later"
+
+
 # ==============================
 # Validation Errors (4xx)
 # ==============================
@@ -57,6 +62,11 @@ class RequestJsonError(ValidationError):
     description = "Bad request"
 
 
+class InvalidCursorError(ValidationError):
+    code = 400
+    description = "Invalid cursor"
+
+
 # ==============================
 # User Errors (4xx)
 # ==============================
@@ -85,6 +95,11 @@ class OtpRetryLimitError(UserError):
     description = "Please try again after 2 minutes"
 
 
+class OtpRateLimitError(UserError):
+    code = 429
+    description = "Too many OTP requests, please try again later"
+
+
 class AuthenticationError(UserError):
     code = 401
     description = "Invalid credentials"
@@ -120,6 +135,21 @@ class NoteDeleteForbiddenError(NoteError):
     description = "Delete not allowed!"
 
 
+# ==============================
+# Rate Limit Errors (429)
+# ==============================
+class RateLimitError(BaseAPIError):
+    code = 429
+    description = "Too many requests, please try again later"
+
+    def __init__(self, retry_after: int):
+        super().__init__()
+        self.retry_after = retry_after
+
+    def get_headers(self, environ=None, scope=None):
+        return [("Retry-After", str(self.retry_after))]
+
+
 # ==============================
 # JWT / Authentication Errors
 # ==============================
@@ -0,0 +1,110 @@
+import os
+import bcrypt
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask
+from flaskapp.exceptions import ServiceUnavailableError
+
+
+# run inside the pool processes
+def _hash_password(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode(
+        "utf-8"
+    )
+
+
+def _check_password(pw_hash: str, password: str) -> bool:
+    return bcrypt.checkpw(password.encode("utf-8"), pw_hash.encode("utf-8"))
+
+
+# cost factor of a stored hash, $2b$<rounds>$<salt and hash>
+def hash_rounds(pw_hash: str) -> int:
+    return int(pw_hash.split("$")[2])
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a bounded process pool instead of the request thread.
+    When more than PASSWORD_HASH_MAX_PENDING hashes are queued new requests
+    are rejected right away with a 503.
+    """
+
+    def __init__(self, app: Flask | None = None):
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app: Flask):
+        self.rounds = app.config["BCRYPT_LOG_ROUNDS"]
+        self.workers = app.config["PASSWORD_HASH_WORKERS"]
+        self.timeout = app.config["PASSWORD_HASH_TIMEOUT"]
+        self._pending = threading.BoundedSemaphore(
+            app.config["PASSWORD_HASH_MAX_PENDING"]
+        )
+
+    def generate_password_hash(self, password: str) -> str:
+        return self._submit(_hash_password, password, self.rounds)
+
+    def check_password_hash(self, pw_hash: str, password: str) -> bool:
+        return self._submit(_check_password, pw_hash, password)
+
+    # stored hash was made with a different cost than the current target
+    def needs_rehash(self, pw_hash: str) -> bool:
+        return hash_rounds(pw_hash) != self.rounds
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # a pool inherited from the gunicorn master is not usable after fork
+        if self._pool is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pool is None or self._pid != os.getpid():
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                    self._pid = os.getpid()
+        return self._pool
+
+    # a killed pool process (oom killer) breaks the whole pool for good
+    def _drop_pool(self, pool: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, fn, *args):
+        pool = self._get_pool()
+        try:
+            return self._submit_to(pool, fn, *args)
+        except BrokenProcessPool:
+            logging.error("Password hashing pool is broken, starting a new one")
+            self._drop_pool(pool)
+            return self._submit_to(self._get_pool(), fn, *args)
+
+    def _submit_to(self, pool: ProcessPoolExecutor, fn, *args):
+        if not self._pending.acquire(blocking=False):
+            logging.warning("Password hashing queue is full")
+            raise ServiceUnavailableError()
+
+        try:
+            future = pool.submit(fn, *args)
+            try:
+                return future.result(timeout=self.timeout)
+            finally:
+                # a hash still queued is dropped, its client got a 503
+                future.cancel()
+        except TimeoutError:
+            logging.error("Password hashing timed out")
+            raise ServiceUnavailableError()
+        finally:
+            self._pending.release()
@@ -0,0 +1,180 @@
+import json
+import time
+import uuid
+import logging
+import threading
+from flask import current_app
+from flask_mail import Message
+from flaskapp import mail
+from flaskapp.caching import redis_client, RedisKeys
+
+# due retries go back to the queue atomically, a job is never in both
+SCHEDULE_RETRIES_SCRIPT = redis_client.register_script(
+    """
+    local jobs = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, ARGV[2])
+    for _, job in ipairs(jobs) do
+        redis.call("ZREM", KEYS[1], job)
+        redis.call("LPUSH", KEYS[2], job)
+    end
+    return #jobs
+    """
+)
+
+
+# the request path only pushes the job, the worker sends it
+def enqueue_mail(
+    subject: str, sender: str, recipients: list, body: str, ttl: int | None = None
+) -> None:
+    job = {
+        "id": uuid.uuid4().hex,
+        "subject": subject,
+        "sender": sender,
+        "recipients": recipients,
+        "body": body,
+        "attempts": 0,
+        # a job that can not be delivered in time is dropped, e.g. an expired otp
+        "expires": time.time() + ttl if ttl else None,
+    }
+    redis_client.lpush(RedisKeys.MAIL_QUEUE, json.dumps(job))
+
+
+class MailWorker:
+    """
+    Sends queued mail in batches over one SMTP connection which is kept open
+    between batches. A job stays in the worker's own processing list while it
+    is sent, a failed job is retried with exponential backoff.
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.processing = RedisKeys.mail_processing(self.id)
+        self.connection = None
+        self.last_used = 0.0
+        self.last_recovered = 0.0
+
+    def run(self, stop: threading.Event | None = None) -> None:
+        stop = stop or threading.Event()
+        try:
+            while not stop.is_set():
+                if time.monotonic() - self.last_recovered > self.worker_ttl:
+                    self.recover()
+                self.run_once()
+        finally:
+            self.close()
+            # a clean stop hands the unsent jobs to the other workers
+            self.release(self.id)
+
+    @property
+    def worker_ttl(self) -> int:
+        return current_app.config["MAIL_WORKER_TTL"]
+
+    def heartbeat(self) -> None:
+        pipe = redis_client.pipeline()
+        pipe.sadd(RedisKeys.MAIL_WORKERS, self.id)
+        pipe.set(RedisKeys.mail_worker(self.id), 1, ex=self.worker_ttl)
+        pipe.execute()
+
+    # jobs left in processing by a worker without a heartbeat are sent again,
+    # the jobs of live workers are left alone
+    def recover(self) -> None:
+        self.last_recovered = time.monotonic()
+        for worker_id in redis_client.smembers(RedisKeys.MAIL_WORKERS):
+            if worker_id == self.id:
+                continue
+            if not redis_client.exists(RedisKeys.mail_worker(worker_id)):
+                self.release(worker_id)
+
+    def release(self, worker_id: str) -> None:
+        processing = RedisKeys.mail_processing(worker_id)
+        while redis_client.lmove(processing, RedisKeys.MAIL_QUEUE, "RIGHT", "RIGHT"):
+            pass
+        pipe = redis_client.pipeline()
+        pipe.srem(RedisKeys.MAIL_WORKERS, worker_id)
+        pipe.delete(RedisKeys.mail_worker(worker_id))
+        pipe.execute()
+
+    def run_once(self, timeout: int | None = None) -> int:
+        config = current_app.config
+        self.heartbeat()
+        SCHEDULE_RETRIES_SCRIPT(
+            keys=[RedisKeys.MAIL_RETRY, RedisKeys.MAIL_QUEUE],
+            args=[time.time(), config["MAIL_BATCH_SIZE"]],
+        )
+
+        if timeout is None:
+            timeout = config["MAIL_POLL_TIMEOUT"]
+        batch = self.take_batch(timeout)
+        if not batch:
+            if time.monotonic() - self.last_used > config["MAIL_IDLE_TIMEOUT"]:
+                self.close()
+            return 0
+
+        for raw in batch:
+            self.heartbeat()
+            self.send(raw)
+        return len(batch)
+
+    # block for the first job, then take whatever else is already queued
+    def take_batch(self, timeout: int) -> list:
+        raw = redis_client.blmove(
+            RedisKeys.MAIL_QUEUE, self.processing, timeout, "RIGHT", "LEFT"
+        )
+        batch = []
+        while raw is not None:
+            batch.append(raw)
+            if len(batch) >= current_app.config["MAIL_BATCH_SIZE"]:
+                break
+            raw = redis_client.lmove(
+                RedisKeys.MAIL_QUEUE, self.processing, "RIGHT", "LEFT"
+            )
+        return batch
+
+    def send(self, raw: str) -> None:
+        job = json.loads(raw)
+        if job["expires"] and job["expires"] < time.time():
+            logging.warning(f"Dropped expired mail job id={job['id']}")
+            redis_client.lrem(self.processing, 1, raw)
+            return
+
+        msg = Message(job["subject"], sender=job["sender"], recipients=job["recipients"])
+        msg.body = job["body"]
+        try:
+            self.get_connection().send(msg)
+        except Exception as e:
+            # the connection may be broken, open a new one for the next job
+            self.close()
+            self.retry(raw, job, e)
+        else:
+            redis_client.lrem(self.processing, 1, raw)
+
+    def retry(self, raw: str, job: dict, error: Exception) -> None:
+        job["attempts"] += 1
+        pipe = redis_client.pipeline()
+        pipe.lrem(self.processing, 1, raw)
+        if job["attempts"] >= current_app.config["MAIL_MAX_ATTEMPTS"]:
+            logging.error(f"Failed to send mail id={job['id']}. Error: {str(error)}")
+            pipe.lpush(RedisKeys.MAIL_FAILED, json.dumps(job))
+        else:
+            logging.warning(
+                f"Failed to send mail id={job['id']}, attempt {job['attempts']}. "
+                f"Error: {str(error)}"
+            )
+            delay = current_app.config["MAIL_RETRY_BACKOFF"] * 2 ** (job["attempts"] - 1)
+            pipe.zadd(RedisKeys.MAIL_RETRY, {json.dumps(job): time.time() + delay})
+        pipe.execute()
+
+    def get_connection(self):
+        if self.connection is None:
+            connection = mail.connect()
+            connection.__enter__()
+            self.connection = connection
+        self.last_used = time.monotonic()
+        return self.connection
+
+    def close(self) -> None:
+        if self.connection is not None:
+            try:
+                self.connection.__exit__(None, None, None)
+            except Exception:
+                pass
+            self.connection = None
@@ -1,4 +1,4 @@
-from pydantic import BaseModel, constr
+from pydantic import BaseModel, constr, field_validator
 from flaskapp.config import Config
 
 username_validator = constr(
@@ -23,3 +23,10 @@ class SingleNoteRequest(BaseModel):
         )
         | None
     ) = ""
+
+    # "01" and "1" are the same note, cache keys are built from the int
+    @field_validator("note_id")
+    def validate_note_id(cls, v: str) -> int:
+        if not (v.isascii() and v.isdigit()):
+            raise ValueError("Note id must be a number.")
+        return int(v)
@@ -1,10 +1,15 @@
 from flask import Blueprint
 from flaskapp.main import service
+from flaskapp.utils import rate_limit
+from flaskapp.replica import route_to_replica
 
 
 # main blueprint
 main_bp = Blueprint("main", __name__)
 
+# public read only endpoints, read from the replica when one is configured
+main_bp.before_request(route_to_replica)
+
 
 @main_bp.route("/home/")
 def home():
@@ -12,6 +17,7 @@ def home():
 
 
 @main_bp.route("/single-note/", methods=["POST"])
+@rate_limit("single-note")
 def single_note():
     return service.get_single_note()
 
@@ -1,13 +1,29 @@
-import json
+import hmac
 import logging
 from typing import Union, Tuple
-from flask import jsonify, Response
-from sqlalchemy import func
+from flask import request, current_app, jsonify, Response
+from sqlalchemy import tuple_
 from flaskapp import db
-from flaskapp.caching import redis_client, RedisKeys
+from flaskapp.caching import (
+    RedisKeys,
+    MISSING_ENTRY,
+    get_generation,
+    get_or_set,
+    pack_entry,
+    unpack_entry,
+)
+from flaskapp.counters import read_counters
+from flaskapp.replica import check_sticky
 from flaskapp.db_models import User, Notes
 from flaskapp.main import model
-from flaskapp.utils import response_body_validator
+from flaskapp.timing import phase
+from flaskapp.utils import (
+    response_body_validator,
+    encode_cursor,
+    decode_cursor,
+    json_body,
+    cached_json_response,
+)
 from flaskapp.exceptions import (
     InternalServerError,
     UserNotFoundError,
@@ -17,53 +33,15 @@ from flaskapp.exceptions import (
 )
 
 
-# total user cout
-def user_count() -> int:
-    cache_key = RedisKeys.TOTAL_USER
-    total_user = redis_client.get(cache_key)
-    if total_user:
-        return int(total_user)
-
-    total_user = User.query.count()
-    redis_client.setex(cache_key, 60 * 60, str(total_user))
-    return total_user
-
-
-# total note count
-def note_count() -> int:
-    cache_key = RedisKeys.TOTAL_NOTE
-    total_note = redis_client.get(cache_key)
-    if total_note:
-        return int(total_note)
-
-    total_note = Notes.query.count()
-    redis_client.setex(cache_key, 60 * 60, str(total_note))
-    return total_note
-
-
-# total char in all notes
-def total_char() -> int:
-    cache_key = RedisKeys.TOTAL_CHAR
-    total_char = redis_client.get(cache_key)
-    if total_char:
-        return int(total_char)
-
-    char_sum = (
-        db.session.query(
-            func.sum(func.length(Notes.title) + func.length(Notes.text))
-        ).scalar()
-    ) or 0
-    redis_client.setex(cache_key, 60 * 60, str(char_sum))
-    return char_sum
-
-
+# homepage counters are maintained by the write paths, no table scan here
 def homepage_stats() -> Union[Response, Tuple[Response, int]]:
     try:
+        counters = read_counters()
         return jsonify(
             {
-                "totalUser": user_count(),
-                "totalNotes": note_count(),
-                "totalChar": total_char(),
+                "totalUser": counters[RedisKeys.TOTAL_USER],
+                "totalNotes": counters[RedisKeys.TOTAL_NOTE],
+                "totalChar": counters[RedisKeys.TOTAL_CHAR],
             }
         ), 200
     except Exception as e:
@@ -71,34 +49,66 @@ def homepage_stats() -> Union[Response, Tuple[Response, int]]:
         raise InternalServerError()
 
 
-# query a user by username
-def get_user_by_username(username: str) -> User:
+# user lookup and one page of the note listing in one query, only the
+# listed columns are loaded, never the note text
+def user_note_rows_query(username: str, after: str, limit: int):
+    note_filter = Notes.user_id == User.id
+    if after:
+        date_created, note_id = decode_cursor(after)
+        # filter inside the join, the user row is returned even past the last note
+        note_filter &= tuple_(Notes.date_created, Notes.id) < tuple_(
+            date_created, note_id
+        )
+
+    return (
+        db.session.query(Notes.id, Notes.title, Notes.date_created, Notes.pin)
+        .select_from(User)
+        .outerjoin(Notes, note_filter)
+        .filter(User.username == username)
+        .order_by(Notes.date_created.desc(), Notes.id.desc())
+        .limit(limit)
+    )
+
+
+def get_user_note_rows(username: str, after: str, limit: int) -> list:
+    query = user_note_rows_query(username, after, limit)
     try:
-        user = User.query.filter_by(username=username).first()
-        if user is None:
+        rows = query.all()
+        if not rows:
             logging.warning(f"User not found for username={username}")
             raise UserNotFoundError()
-        return user
+
+        # outer join row without a note, the user has no (more) notes
+        return [row for row in rows if row.id is not None]
     except UserNotFoundError:
         raise
     except Exception as e:
-        logging.error(f"Failed to get user. Error: {str(e)}")
+        logging.error(f"Failed to get user notes. Error: {str(e)}")
         raise InternalServerError()
 
 
 def get_user_note_list(username: str) -> Union[Response, Tuple[Response, int]]:
-    validated = model.PublicProfileRequest(username=username)
-    user = get_user_by_username(validated.username)
-
-    cache_key = RedisKeys.user_notes(validated.username)
-    # cache hit return notes
-    cached_notes = redis_client.get(cache_key)
-    if cached_notes:
-        return jsonify(json.loads(cached_notes)), 200
-
-    notes_data = []
-    if user.notes:
-        for note in user.notes:
+    with phase("validate"):
+        validated = model.PublicProfileRequest(username=username)
+    after = request.args.get("after", "")
+    per_page = current_app.config["PROFILE_NOTES_PER_PAGE"]
+
+    def load() -> bytes:
+        check_sticky(RedisKeys.sticky_user(validated.username))
+
+        # one extra row tells if there is a next page
+        try:
+            rows = get_user_note_rows(validated.username, after, per_page + 1)
+        except UserNotFoundError:
+            return MISSING_ENTRY
+
+        next_cursor = None
+        if len(rows) > per_page:
+            rows = rows[:per_page]
+            next_cursor = encode_cursor(rows[-1].date_created, rows[-1].id)
+
+        notes_data = []
+        for note in rows:
             notes_data.append(
                 {
                     "id": note.id,
@@ -107,17 +117,45 @@ def get_user_note_list(username: str) -> Union[Response, Tuple[Response, int]]:
                     "isLocked": bool(note.pin),
                 }
             )
-
-    # cache miss save notes in redis
-    redis_client.set(cache_key, json.dumps(notes_data))
-
-    return jsonify(notes_data), 200
-
-
-# get a single not by id
-def get_note_by_id(note_id: int) -> Notes:
+        body = json_body({"notes": notes_data, "nextCursor": next_cursor})
+        return pack_entry(body)
+
+    # every page is a field of the user's hash key, the number of cached
+    # pages per user is capped. A note change moves the user's generation,
+    # the old key is never read again and expires.
+    generation = get_generation(RedisKeys.user_generation(validated.username))
+    cache_key = RedisKeys.user_notes(validated.username, generation)
+    entry = get_or_set(
+        cache_key,
+        load,
+        ttl=current_app.config["PROFILE_CACHE_TTL"],
+        field=after,
+        max_fields=current_app.config["PROFILE_CACHE_MAX_PAGES"],
+    )
+    if entry == MISSING_ENTRY:
+        raise UserNotFoundError()
+    _, body, compressed = unpack_entry(entry)
+    return cached_json_response(body, compressed)
+
+
+# get a single note and its author name by id in one query
+def single_note_query(note_id: int):
+    return (
+        db.session.query(
+            User.username,
+            Notes.title,
+            Notes.text,
+            Notes.date_created,
+            Notes.pin,
+        )
+        .join(User, Notes.user_id == User.id)
+        .filter(Notes.id == note_id)
+    )
+
+
+def get_note_by_id(note_id: int):
     try:
-        note = db.session.get(Notes, note_id)
+        note = single_note_query(note_id).first()
         if note is None:
             logging.warning(f"Note not found for note_id={note_id}")
             raise NoteNotFound()
@@ -132,58 +170,43 @@ def get_note_by_id(note_id: int) -> Notes:
 def get_single_note() -> Union[Response, Tuple[Response, int]]:
     validated = response_body_validator(model.SingleNoteRequest)
 
+    def load() -> bytes:
+        check_sticky(RedisKeys.sticky_note(validated.note_id))
+        try:
+            note = get_note_by_id(validated.note_id)
+        except NoteNotFound:
+            return MISSING_ENTRY
+        body = json_body(
+            {
+                "username": note.username,
+                "title": note.title,
+                "text": note.text,
+                "date": note.date_created.isoformat(),
+            }
+        )
+        # the pin is kept next to the body, never inside it
+        return pack_entry(body, meta=(note.pin or "").encode())
+
+    # on cache miss only one request loads the note from the database
     cache_key = RedisKeys.single_note(validated.note_id)
-    # cache hit return note
-    cached_note = redis_client.get(cache_key)
-    if cached_note:
-        note_data = json.loads(cached_note)
-
-        # Validate PIN for cached notes
-        if note_data.get("isLocked"):
-            if not validated.pin:
-                logging.warning(f"Pin required for note_id: {note_data['id']}")
-                raise NotePinRequiredError()
-            if note_data["pin"] != validated.pin:
-                logging.warning(
-                    f"Pin mismatch for note_id={note_data['id']}: provided={validated.pin}"
-                )
-                raise NotePinMismatchError()
-
-        # remove pin and return note
-        note_data.pop("pin", None)
-        return jsonify(note_data), 200
-
-    # cache miss
-    note = get_note_by_id(int(validated.note_id))
+    entry = get_or_set(cache_key, load)
+    if entry == MISSING_ENTRY:
+        raise NoteNotFound()
+    pin, body, compressed = unpack_entry(entry)
 
     # if note has a pin
-    if note.pin:
+    if pin:
         # the request dose not contain a pin
         if not validated.pin:
-            logging.warning(f"Pin required for note_id: {note.id}")
+            logging.warning(f"Pin required for note_id: {validated.note_id}")
             raise NotePinRequiredError()
 
         # pin dosen't match
-        if note.pin != validated.pin:
+        if not hmac.compare_digest(pin, validated.pin.encode()):
             logging.warning(
-                f"Pin mismatch for note_id={note.id}: provided={validated.pin}"
+                f"Pin mismatch for note_id={validated.note_id}: provided={validated.pin}"
             )
             raise NotePinMismatchError()
 
-    note_data = {
-        "username": note.author.username,
-        "title": note.title,
-        "text": note.text,
-        "date": note.date_created.isoformat(),
-        "isLocked": bool(note.pin),
-        "pin": note.pin,
-    }
-
-    # cache note
-    redis_client.set(cache_key, json.dumps(note_data))
-
-    # Return without pin and locked status
-    note_data.pop("pin", None)
-    note_data.pop("isLocked", None)
-
-    return jsonify(note_data), 200
+    # cached body goes out as is, no decode and re-encode
+    return cached_json_response(body, compressed)
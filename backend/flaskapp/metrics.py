@@ -0,0 +1,107 @@
+import os
+import hmac
+import time
+from flask import Flask, Response, current_app, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from flaskapp.exceptions import ForbiddenAuthError
+
+# seconds, from a local cache hit to a slow database query
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5
+)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Request latency per route",
+    ["endpoint", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_PHASE_SECONDS = Histogram(
+    "request_phase_seconds",
+    "Time spent per request phase",
+    ["endpoint", "phase"],
+    buckets=LATENCY_BUCKETS,
+)
+
+# labelled by RedisKeys.family, layer is local (in-process) or redis
+CACHE_HITS = Counter("cache_hits", "Cache hits", ["family", "layer"])
+CACHE_MISSES = Counter("cache_misses", "Cache misses", ["family"])
+CACHE_EVICTIONS = Counter(
+    "cache_evictions", "Entries evicted from the local cache", ["family"]
+)
+
+DB_QUERIES = Counter("db_queries", "Database queries", ["engine"])
+# summed over the live workers
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "Database connections in use",
+    ["engine"],
+    multiprocess_mode="livesum",
+)
+DB_POOL_CAPACITY = Gauge(
+    "db_pool_capacity",
+    "Database connections a pool can open",
+    ["engine"],
+    multiprocess_mode="livesum",
+)
+
+
+def count_queries(engine, name: str) -> None:
+    queries = DB_QUERIES.labels(name)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        queries.inc()
+
+
+# started is given by the ASGI fast path, which runs before the flask hooks
+def start_request_timer(started: float | None = None) -> None:
+    g.request_started = started or time.perf_counter()
+
+
+def observe_request(response: Response) -> Response:
+    started = g.pop("request_started", None)
+    if started is not None:
+        REQUEST_SECONDS.labels(
+            request.endpoint or "unmatched", request.method, response.status_code
+        ).observe(time.perf_counter() - started)
+    return response
+
+
+# under gunicorn every worker writes its values to files in
+# PROMETHEUS_MULTIPROC_DIR (see gunicorn.conf.py), any worker answers with
+# the sum of all workers. The scraper sends METRICS_TOKEN as a bearer token.
+def metrics_view() -> Response:
+    token = current_app.config["METRICS_TOKEN"]
+    header = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(header.encode(), f"Bearer {token}".encode()):
+        raise ForbiddenAuthError()
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def init_metrics(app: Flask) -> None:
+    with app.app_context():
+        for key, engine in app.extensions["sqlalchemy"].engines.items():
+            count_queries(engine, key or "default")
+
+    app.before_request(start_request_timer)
+    app.after_request(observe_request)
+    # the api port is public, /metrics only exists with a token to check
+    if app.config["METRICS_TOKEN"]:
+        app.add_url_rule("/metrics", "metrics", metrics_view)
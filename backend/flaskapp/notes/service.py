@@ -1,11 +1,14 @@
 import logging
 from typing import Union, Tuple
 from flask import request, jsonify, Response
+from sqlalchemy import tuple_
 from flaskapp import db
-from flaskapp.caching import redis_client, RedisKeys
+from flaskapp.caching import RedisKeys, invalidate, bump_generation
+from flaskapp.counters import update_counters
+from flaskapp.replica import stick_to_primary
 from flaskapp.db_models import Notes
 from flaskapp.notes import model
-from flaskapp.utils import response_body_validator
+from flaskapp.utils import response_body_validator, encode_cursor, decode_cursor
 from flaskapp.exceptions import (
     NoteNotFound,
     NoteDeleteForbiddenError,
@@ -13,12 +16,29 @@ from flaskapp.exceptions import (
 )
 
 
+NOTES_PER_PAGE = 6
+
+
+def note_info(note) -> dict:
+    return {
+        "id": note.id,
+        "info": {
+            "title": note.title,
+            "dateCreated": note.date_created,
+            "text": note.text,
+            "pin": note.pin,
+        },
+    }
+
+
 def current_user_note_list(current_user):
+    # keyset pagination, ?after=<cursor> and an empty cursor for the first page
+    if "after" in request.args:
+        return current_user_note_cursor_list(current_user, request.args["after"])
+
     page = request.args.get("page", 1, type=int)
-    note_list = (
-        Notes.query.filter_by(user_id=current_user.id)
-        .order_by(Notes.date_created.desc())
-        .paginate(page=page, per_page=6)
+    note_list = user_notes_query(current_user.id).paginate(
+        page=page, per_page=NOTES_PER_PAGE
     )
 
     pagination = {
@@ -32,21 +52,35 @@ def current_user_note_list(current_user):
         ),
     }
 
-    notes = []
-    for note in note_list.items:
-        notes.append(
-            {
-                "id": note.id,
-                "info": {
-                    "title": note.title,
-                    "dateCreated": note.date_created,
-                    "text": note.text,
-                    "pin": note.pin,
-                },
-            }
+    notes = [note_info(note) for note in note_list.items]
+    return jsonify({"pagination": pagination, "notes": notes}), 200
+
+
+# newest first, the order of ix_notes_user_id_date_created_id
+def user_notes_query(user_id: int, after: str = ""):
+    query = Notes.query.filter_by(user_id=user_id)
+    if after:
+        date_created, note_id = decode_cursor(after)
+        query = query.filter(
+            tuple_(Notes.date_created, Notes.id) < tuple_(date_created, note_id)
         )
+    return query.order_by(Notes.date_created.desc(), Notes.id.desc())
 
-    return jsonify({"pagination": pagination, "notes": notes}), 200
+
+# no OFFSET and no COUNT(*), every page is an index range scan
+def current_user_note_cursor_list(current_user, after: str):
+    # one extra row tells if there is a next page
+    note_list = (
+        user_notes_query(current_user.id, after).limit(NOTES_PER_PAGE + 1).all()
+    )
+
+    next_cursor = None
+    if len(note_list) > NOTES_PER_PAGE:
+        note_list = note_list[:NOTES_PER_PAGE]
+        next_cursor = encode_cursor(note_list[-1].date_created, note_list[-1].id)
+
+    notes = [note_info(note) for note in note_list]
+    return jsonify({"notes": notes, "nextCursor": next_cursor}), 200
 
 
 # get a single note by id
@@ -64,32 +98,32 @@ def delete_note_by_id(current_user, note_id) -> Union[Response, Tuple[Response,
     validated = model.DeleteNoteRequest(note_id=note_id)
 
     note = get_note_by_id(validated.note_id)
-    if note.author != current_user:
-        logging.error(f"{note.author} is not current_user")
+    if note.user_id != current_user.id:
+        logging.error(f"user_id={note.user_id} is not current_user id={current_user.id}")
         raise NoteDeleteForbiddenError()
 
     try:
         title = note.title
+        update_counters(notes=-1, chars=-(len(note.title) + len(note.text)))
+
+        # after delete a note drop the cached note list (a new generation for
+        # the user) and the cached note from redis and from the local cache of
+        # every worker, sent with the counters in one round trip once the
+        # delete is committed
+        # main blueprint -> get_user_note_list, get_single_note
+        bump_generation(db.session, RedisKeys.user_generation(current_user.username))
+        invalidate(db.session, RedisKeys.single_note(validated.note_id))
+        stick_to_primary(
+            db.session,
+            RedisKeys.sticky_user(current_user.username),
+            RedisKeys.sticky_note(validated.note_id),
+        )
         db.session.delete(note)
         db.session.commit()
     except Exception as e:
         logging.error(f"Failed to delete note id={validated.note_id}. Error: {str(e)}")
         raise InternalServerError()
 
-    # after delete a note if the note is cached then delete the cache
-    # main blueprint -> get_user_note_list service
-    cache_key = RedisKeys.user_notes(current_user.username)
-    cached_notes = redis_client.get(cache_key)
-    if cached_notes:
-        redis_client.delete(cache_key)
-
-    # if only the deleted note stored on cache
-    # main blueprint -> get_single_note
-    cache_key = RedisKeys.single_note(validated.note_id)
-    cached_notes = redis_client.get(cache_key)
-    if cached_notes:
-        redis_client.delete(cache_key)
-
     return jsonify({"title": title, "id": validated.note_id}), 200
 
 
@@ -102,32 +136,28 @@ def create_note(current_user) -> Union[Response, Tuple[Response, int]]:
             pin=validated.pin,
             title=validated.title,
             text=validated.text,
-            author=current_user,
+            user_id=current_user.id,
         )
         db.session.add(note)
+        # flush to get the id, a cached miss for the new id is dropped too
+        db.session.flush()
+        update_counters(notes=1, chars=len(note.title) + len(note.text))
+
+        # after create a new note drop the cached notes for this user
+        # main blueprint -> get_user_note_list, get_single_note
+        bump_generation(db.session, RedisKeys.user_generation(current_user.username))
+        invalidate(db.session, RedisKeys.single_note(note.id))
+        stick_to_primary(
+            db.session,
+            RedisKeys.sticky_user(current_user.username),
+            RedisKeys.sticky_note(note.id),
+        )
         db.session.commit()
-
-        # after create a new note if the notes are cached for this user
-        # main blueprint -> get_user_note_list service
-        cache_key = RedisKeys.user_notes(current_user.username)
-        cached_notes = redis_client.get(cache_key)
-        if cached_notes:
-            redis_client.delete(cache_key)
     except Exception as e:
         logging.error(f"Failed to create new note. Error {str(e)}")
         raise InternalServerError()
 
-    data = {
-        "id": note.id,
-        "info": {
-            "title": note.title,
-            "dateCreated": note.date_created,
-            "text": note.text,
-            "pin": note.pin,
-        },
-    }
-
-    return jsonify(data), 201
+    return jsonify(note_info(note)), 201
 
 
 # update a user note
@@ -135,34 +165,34 @@ def edit_user_note(current_user) -> Union[Response, Tuple[Response, int]]:
     validated = response_body_validator(model.UpdateNoteRequest)
 
     note = get_note_by_id(validated.note_id)
-    if note.author != current_user:
-        logging.error(f"{note.author} is not current_user")
+    if note.user_id != current_user.id:
+        logging.error(f"user_id={note.user_id} is not current_user id={current_user.id}")
         raise NoteDeleteForbiddenError()
 
     try:
         # changes in database
+        char_delta = len(validated.title) + len(validated.text)
+        char_delta -= len(note.title) + len(note.text)
         note.title = validated.title
         note.text = validated.text
         note.pin = validated.pin
+        update_counters(chars=char_delta)
+
+        # after edit a note drop the cached note list and the cached note
+        # from redis and from the local cache of every worker
+        # main blueprint -> get_user_note_list, get_single_note
+        bump_generation(db.session, RedisKeys.user_generation(current_user.username))
+        invalidate(db.session, RedisKeys.single_note(validated.note_id))
+        stick_to_primary(
+            db.session,
+            RedisKeys.sticky_user(current_user.username),
+            RedisKeys.sticky_note(validated.note_id),
+        )
         db.session.commit()
     except Exception as e:
         logging.error(f"Failed to edit note id={validated.note_id}. Error: {str(e)}")
         raise InternalServerError()
 
-    # after edit a note if the notes are cached for this user
-    # main blueprint -> get_user_note_list service
-    cache_key = RedisKeys.user_notes(current_user.username)
-    cached_notes = redis_client.get(cache_key)
-    if cached_notes:
-        redis_client.delete(cache_key)
-
-    # if only the edited note stored on cache
-    # main blueprint -> get_single_note
-    cache_key = RedisKeys.single_note(validated.note_id)
-    cached_notes = redis_client.get(cache_key)
-    if cached_notes:
-        redis_client.delete(cache_key)
-
     return jsonify(
         {"id": note.id, "title": note.title, "text": note.text, "pin": note.pin}
     ), 200
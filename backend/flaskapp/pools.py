@@ -0,0 +1,134 @@
+import time
+import logging
+from flask import Flask
+from sqlalchemy import event, text
+from sqlalchemy.pool import QueuePool
+from flaskapp.caching import redis_client, redis_bytes_client, invalidation_listener
+from flaskapp.metrics import DB_POOL_CAPACITY, DB_POOL_CHECKED_OUT
+
+# at most one saturation warning per pool in this many seconds
+SATURATION_LOG_INTERVAL = 60
+
+# QueuePool default when an engine sets no max_overflow
+DEFAULT_MAX_OVERFLOW = 10
+
+
+# pool sizes only apply to server databases, sqlite gets the pool
+# Flask-SQLAlchemy picks for it (a static pool for memory databases)
+def engine_options(app: Flask, uri) -> dict:
+    uri = str(uri or "")
+    options = {"pool_recycle": app.config["DB_POOL_RECYCLE"], "pool_pre_ping": True}
+    if not uri.startswith("sqlite"):
+        options["pool_size"] = app.config["DB_POOL_SIZE"]
+        options["max_overflow"] = app.config["DB_MAX_OVERFLOW"]
+        options["pool_timeout"] = app.config["DB_POOL_TIMEOUT"]
+    if uri.startswith("postgresql"):
+        timeout = app.config["DB_STATEMENT_TIMEOUT"]
+        options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+    return options
+
+
+# options of the primary and of every bind given as a plain url, explicit
+# SQLALCHEMY_ENGINE_OPTIONS and bind dicts win
+def configure_engines(app: Flask) -> None:
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        **engine_options(app, uri),
+        **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+    }
+    binds = {}
+    for key, bind in app.config.get("SQLALCHEMY_BINDS", {}).items():
+        if isinstance(bind, str):
+            bind = {"url": bind, **engine_options(app, bind)}
+        binds[key] = bind
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+
+# max_overflow the engine of a bind key was created with
+def configured_max_overflow(app: Flask, key: str | None) -> int:
+    if key is None:
+        options = app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    else:
+        options = app.config["SQLALCHEMY_BINDS"][key]
+    return options.get("max_overflow", DEFAULT_MAX_OVERFLOW)
+
+
+def pool_stats(engine, max_overflow: int) -> dict:
+    pool = engine.pool
+    # sqlite memory databases use pools without a size
+    if not isinstance(pool, QueuePool):
+        return {}
+
+    capacity = pool.size() + max_overflow
+    return {
+        "size": pool.size(),
+        "capacity": capacity,
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        # share of the connections in use, at 1.0 requests wait for a connection
+        "saturation": pool.checkedout() / capacity if capacity else 0.0,
+    }
+
+
+# export the pool usage and log when a checkout takes the last free
+# connection of the pool
+def watch_pool(engine, name: str, max_overflow: int) -> None:
+    if not isinstance(engine.pool, QueuePool):
+        return
+    last_logged = [0.0]
+    checked_out = DB_POOL_CHECKED_OUT.labels(name)
+    capacity = DB_POOL_CAPACITY.labels(name)
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        # the connection is returned to the pool right after this event
+        checked_out.set(max(engine.pool.checkedout() - 1, 0))
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats = pool_stats(engine, max_overflow)
+        # set per checkout, a forked worker starts with empty metric values
+        capacity.set(stats["capacity"])
+        checked_out.set(stats["checked_out"])
+        if stats["checked_out"] < stats["capacity"]:
+            return
+        if time.monotonic() - last_logged[0] > SATURATION_LOG_INTERVAL:
+            last_logged[0] = time.monotonic()
+            logging.warning(f"Database pool {name} is saturated: {stats}")
+
+
+# open connections before the first request, called once per worker process
+def warm_up(app: Flask, connections: int = 2) -> None:
+    db = app.extensions["sqlalchemy"]
+    with app.app_context():
+        for key, engine in db.engines.items():
+            name = key or "default"
+            held = []
+            try:
+                # held at the same time, so the pool really opens several
+                for _ in range(connections):
+                    connection = engine.connect()
+                    held.append(connection)
+                    connection.execute(text("SELECT 1"))
+            except Exception as e:
+                logging.error(f"Failed to warm up database pool {name}. Error: {e}")
+            finally:
+                for connection in held:
+                    connection.close()
+
+        try:
+            redis_client.ping()
+            redis_bytes_client.ping()
+        except Exception as e:
+            logging.error(f"Failed to warm up redis connections. Error: {e}")
+        invalidation_listener.ensure_started()
+
+
+# a forked worker must not reuse connections opened by the parent process,
+# the parent's sockets are left open for the parent (close=False)
+def reset_after_fork(app: Flask) -> None:
+    db = app.extensions["sqlalchemy"]
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
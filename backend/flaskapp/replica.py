@@ -0,0 +1,111 @@
+import time
+import logging
+import threading
+from flask import g, current_app, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+from flaskapp.caching import redis_client, on_commit
+
+REPLICA_BIND = "replica"
+
+# 0 while the replica has replayed everything it received, otherwise the age
+# of the last replayed transaction
+POSTGRES_LAG_QUERY = text(
+    """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+    """
+)
+
+
+class RoutingSession(Session):
+    """
+    Sends the reads of a request marked by route_to_replica to the replica
+    bind, everything else (and every flush) goes to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and reads_from_replica():
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def reads_from_replica() -> bool:
+    return has_request_context() and g.get("read_replica", False)
+
+
+def replica_configured() -> bool:
+    return REPLICA_BIND in current_app.config["SQLALCHEMY_BINDS"]
+
+
+class ReplicaLag:
+    """Replica lag measured at most once per REPLICA_LAG_CHECK_INTERVAL."""
+
+    def __init__(self):
+        self.checked_at = 0.0
+        self.healthy = False
+        self._lock = threading.Lock()
+
+    def replica_healthy(self) -> bool:
+        interval = current_app.config["REPLICA_LAG_CHECK_INTERVAL"]
+        if time.monotonic() - self.checked_at < interval:
+            return self.healthy
+
+        with self._lock:
+            if time.monotonic() - self.checked_at >= interval:
+                self.healthy = self.check()
+                self.checked_at = time.monotonic()
+        return self.healthy
+
+    def check(self) -> bool:
+        engines = current_app.extensions["sqlalchemy"].engines
+        try:
+            lag = self.measure(engines[REPLICA_BIND])
+        except Exception as e:
+            logging.error(f"Failed to check replica lag. Error: {str(e)}")
+            return False
+
+        if lag > current_app.config["REPLICA_MAX_LAG"]:
+            logging.warning(f"Replica is {lag:.1f}s behind, reading from primary")
+            return False
+        return True
+
+    @staticmethod
+    def measure(engine) -> float:
+        # other databases (sqlite in development) have no replication lag
+        if engine.dialect.name != "postgresql":
+            return 0.0
+        with engine.connect() as connection:
+            return float(connection.execute(POSTGRES_LAG_QUERY).scalar() or 0)
+
+
+replica_lag = ReplicaLag()
+
+
+# before_request of read only blueprints
+def route_to_replica() -> None:
+    g.read_replica = replica_configured() and replica_lag.replica_healthy()
+
+
+# read your writes, after a write the data it touched is read from the
+# primary until the replica surely has it
+def stick_to_primary(session, *keys: str) -> None:
+    if not replica_configured():
+        return
+    ttl = current_app.config["REPLICA_STICKY_SECONDS"]
+    for key in keys:
+        on_commit(session, lambda pipe, key=key: pipe.set(key, 1, ex=ttl))
+
+
+# called before a read of data that may have been written just now
+def check_sticky(*keys: str) -> None:
+    if not reads_from_replica():
+        return
+    try:
+        if redis_client.exists(*keys):
+            g.read_replica = False
+    except Exception as e:
+        logging.error(f"Failed to check replica stickiness. Error: {str(e)}")
+        g.read_replica = False
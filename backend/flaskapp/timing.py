@@ -0,0 +1,119 @@
+import time
+from contextlib import contextmanager
+from flask import Flask, Response, g, request, has_request_context
+from sqlalchemy import event
+from flaskapp.metrics import REQUEST_PHASE_SECONDS
+
+
+# phase durations of the current request, None when timing is disabled
+def timings() -> dict | None:
+    if not has_request_context():
+        return None
+    return g.get("timings")
+
+
+def add_timing(name: str, seconds: float) -> None:
+    current = timings()
+    if current is not None:
+        current[name] = current.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name: str):
+    current = timings()
+    if current is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current[name] = current.get(name, 0.0) + time.perf_counter() - start
+
+
+def timed(func, name: str):
+    def wrapper(*args, **kwargs):
+        current = timings()
+        if current is None:
+            return func(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current[name] = current.get(name, 0.0) + time.perf_counter() - start
+
+    return wrapper
+
+
+# every command and pipeline round trip of the client, scripts included
+def instrument_redis(client) -> None:
+    if getattr(client, "_timed", False):
+        return
+
+    pipeline = client.pipeline
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        pipe.execute = timed(pipe.execute, "redis")
+        return pipe
+
+    client.execute_command = timed(client.execute_command, "redis")
+    client.pipeline = timed_pipeline
+    client._timed = True
+
+
+def instrument_engine(engine) -> None:
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        if context is not None and timings() is not None:
+            context.query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        start = getattr(context, "query_start", None)
+        if start is not None:
+            add_timing("db", time.perf_counter() - start)
+
+
+def start_timing(started: float | None = None) -> None:
+    g.timings = {}
+    g.request_start = started or time.perf_counter()
+
+
+# Server-Timing header, shown per request in the browser dev tools
+def finish_timing(response: Response) -> Response:
+    current = g.pop("timings", None)
+    if current is None:
+        return response
+
+    current["total"] = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or "unmatched"
+    for name, seconds in current.items():
+        REQUEST_PHASE_SECONDS.labels(endpoint, name).observe(seconds)
+
+    response.headers["Server-Timing"] = ", ".join(
+        f"{name};dur={seconds * 1000:.2f}" for name, seconds in current.items()
+    )
+    return response
+
+
+def init_request_timing(app: Flask) -> None:
+    """
+    Times validation, redis, database and serialization per request when
+    REQUEST_TIMING is set. Nothing is wrapped or registered otherwise.
+    """
+    if not app.config["REQUEST_TIMING"]:
+        return
+
+    from flaskapp.caching import redis_client, redis_bytes_client
+
+    instrument_redis(redis_client)
+    instrument_redis(redis_bytes_client)
+    with app.app_context():
+        for engine in app.extensions["sqlalchemy"].engines.values():
+            instrument_engine(engine)
+
+    app.before_request(start_timing)
+    app.after_request(finish_timing)
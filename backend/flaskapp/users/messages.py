@@ -1,17 +1,22 @@
 import logging
-from flaskapp import mail
-from flask_mail import Message
+from flaskapp.mailer import enqueue_mail
 from flaskapp.exceptions import InternalServerError
 
 
+# queued for the mail worker, the request never waits for smtp
 def send_otp(otp: str, email: str) -> None:
-    msg = Message("Verify Your OTP", sender="noreply@demo.com", recipients=[email])
-    msg.body = f"""To confirm your email, Use the OTP. After 2 minutes otp will be invalid.
+    body = f"""To confirm your email, Use the OTP. After 2 minutes otp will be invalid.
 OTP: {otp}
 If you did not make this request then simply ignore this email and no changes will be made.
 """
     try:
-        mail.send(msg)
+        enqueue_mail(
+            "Verify Your OTP",
+            sender="noreply@demo.com",
+            recipients=[email],
+            body=body,
+            ttl=60 * 2,
+        )
     except Exception as e:
-        logging.error(f"Failed to send Verify OTP email. Error: {str(e)}")
+        logging.error(f"Failed to queue Verify OTP email. Error: {str(e)}")
         raise InternalServerError()
@@ -1,6 +1,6 @@
 from flask import Blueprint
 from flaskapp.users import service
-from flaskapp.utils import login_required, logout_required
+from flaskapp.utils import login_required, logout_required, rate_limit
 
 
 users_bp = Blueprint("users", __name__)
@@ -8,6 +8,7 @@ users_bp = Blueprint("users", __name__)
 
 # create user
 @users_bp.route("/sign-up/", methods=["POST"])
+@rate_limit("sign-up")
 @logout_required
 def sign_up():
     return service.two_step_verification()
@@ -22,6 +23,7 @@ def verify():
 
 # login
 @users_bp.route("/log-in/", methods=["POST"])
+@rate_limit("log-in")
 @logout_required
 def log_in():
     return service.get_token()
@@ -1,19 +1,32 @@
 import jwt
+import time
+import uuid
 import random
 import logging
 import datetime
 from typing import Union, Tuple
 from flask import jsonify, current_app, Response
-from flaskapp import bcrypt, db
-from flaskapp.caching import redis_client, RedisKeys
+from flaskapp import hasher, db
+from flaskapp.caching import (
+    redis_client,
+    RedisKeys,
+    invalidate,
+    bump_generation,
+    on_commit,
+    count_lookup,
+)
+from flaskapp.counters import update_counters
+from flaskapp.replica import stick_to_primary
+from flaskapp.bloom import user_filter, name_item, email_item
 from flaskapp.users import model
 from flaskapp.db_models import User
 from flaskapp.users.messages import send_otp
-from flaskapp.utils import response_body_validator
+from flaskapp.utils import response_body_validator, client_ip
 from flaskapp.exceptions import (
     UserEmailConflictError,
     UserUserNameConflictError,
     OtpRetryLimitError,
+    OtpRateLimitError,
     OtpError,
     InternalServerError,
     AuthenticationError,
@@ -27,34 +40,97 @@ def generate_otp() -> str:
     return f"{otp:06}"
 
 
+# store a new otp unless one is still valid for the key, and count the
+# request in the per ip and per email windows, all in one round trip
+RESERVE_OTP_SCRIPT = redis_client.register_script(
+    """
+    if redis.call("EXISTS", KEYS[1]) == 1 then
+        return 1
+    end
+    local now = tonumber(ARGV[3])
+    local window = tonumber(ARGV[4])
+    for i = 2, 3 do
+        redis.call("ZREMRANGEBYSCORE", KEYS[i], "-inf", now - window)
+        if redis.call("ZCARD", KEYS[i]) >= tonumber(ARGV[i + 3]) then
+            return 2
+        end
+    end
+    redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+    for i = 2, 3 do
+        redis.call("ZADD", KEYS[i], now, ARGV[7])
+        redis.call("PEXPIRE", KEYS[i], window)
+    end
+    return 0
+    """
+)
+OTP_ACTIVE = 1
+OTP_LIMITED = 2
+
+
+def reserve_otp(otp_key: str, email: str) -> str:
+    otp = generate_otp()
+    # the client behind the proxy, not the proxy shared by every client
+    client = client_ip()
+    result = RESERVE_OTP_SCRIPT(
+        keys=[
+            otp_key,
+            RedisKeys.otp_ip_window(client),
+            RedisKeys.otp_email_window(email),
+        ],
+        args=[
+            otp,
+            current_app.config["OTP_TTL"],
+            int(time.time() * 1000),
+            current_app.config["OTP_WINDOW"] * 1000,
+            current_app.config["OTP_MAX_PER_IP"],
+            current_app.config["OTP_MAX_PER_EMAIL"],
+            uuid.uuid4().hex,
+        ],
+    )
+
+    # previous otp is still valid
+    if result == OTP_ACTIVE:
+        logging.warning(f"Too many otp request for {otp_key}")
+        raise OtpRetryLimitError()
+
+    if result == OTP_LIMITED:
+        logging.warning(f"Otp rate limit reached for {email} ip={client}")
+        raise OtpRateLimitError()
+    return otp
+
+
+# queue the email, if that fails the reservation is released
+def deliver_otp(otp_key: str, otp: str, email: str) -> None:
+    try:
+        send_otp(otp, email)
+    except InternalServerError:
+        redis_client.delete(otp_key)
+        raise
+
+
 # send verification code
 def two_step_verification() -> Union[Response, Tuple[Response, int]]:
     validated = response_body_validator(model.SignUpRequest)
 
+    # the filter rules out most free names and emails without a query
     # check username in db
-    if User.check_name(validated.username):
+    if user_filter.might_contain(name_item(validated.username)) and User.check_name(
+        validated.username
+    ):
         logging.warning(f"Username: {validated.username} already taken")
         raise UserUserNameConflictError()
 
     # check email in db
-    if User.check_email(validated.email):
+    if user_filter.might_contain(email_item(validated.email)) and User.check_email(
+        validated.email
+    ):
         logging.warning(f"Email: {validated.email} already taken")
         raise UserEmailConflictError()
 
-    # Generate OTP and send it
-    otp = generate_otp()
-    send_otp(otp, validated.email)
-
+    # reserve the otp first, a limited request never sends an email
     otp_key = RedisKeys.sign_up(validated.email)
-
-    # too many request
-    stored_otp = redis_client.get(otp_key)
-    if stored_otp:
-        logging.warning(f"Too many signup request for {validated.email}")
-        raise OtpRetryLimitError()
-
-    # store email and otp for 2 minutes
-    redis_client.setex(otp_key, 60 * 2, otp)
+    otp = reserve_otp(otp_key, validated.email)
+    deliver_otp(otp_key, otp, validated.email)
     return jsonify({"message": "OTP sent to email"}), 200
 
 
@@ -65,20 +141,26 @@ def register_user() -> Union[Response, Tuple[Response, int]]:
     # check stored otp for given email in redis cache
     otp_key = RedisKeys.sign_up(validated.email)
     stored_otp = redis_client.get(otp_key)
+    count_lookup(otp_key, stored_otp is not None)
 
     # check otp in redis client and if there is a otp, match with given otp
     if not stored_otp or stored_otp != validated.otp:
         raise OtpError()
 
-    hashed_pass = bcrypt.generate_password_hash(validated.password, rounds=13).decode(
-        "utf-8"
-    )
+    hashed_pass = hasher.generate_password_hash(validated.password)
     username = validated.username.replace(" ", "-").lower()
 
     try:
         user = User(username=username, email=validated.email, password=hashed_pass)
         db.session.add(user)
+        update_counters(users=1)
+
+        # the profile may be cached as not found
+        # main blueprint -> get_user_note_list
+        bump_generation(db.session, RedisKeys.user_generation(username))
+        stick_to_primary(db.session, RedisKeys.sticky_user(username))
         db.session.commit()
+        user_filter.add(name_item(username), email_item(validated.email))
         redis_client.delete(otp_key)
     except Exception as e:
         logging.error(f"User registration failed. Error: {str(e)}")
@@ -104,9 +186,22 @@ def get_user_by_email(email: str) -> User:
 def authenticate_user(email, password) -> User:
     user = get_user_by_email(email)
 
-    if not bcrypt.check_password_hash(user.password, password):
+    if not hasher.check_password_hash(user.password, password):
         logging.warning(f"Authentication failed password mitchmatched email={email}")
         raise AuthenticationError()
+
+    # stored hash was made with an older cost factor, upgrade it now that
+    # the plain password is known
+    if hasher.needs_rehash(user.password):
+        try:
+            user.password = hasher.generate_password_hash(password)
+            db.session.commit()
+        except Exception as e:
+            # the old hash still works, try again on the next login
+            db.session.rollback()
+            logging.error(
+                f"Failed to rehash password for email={email}. Error: {str(e)}"
+            )
     return user
 
 
@@ -133,25 +228,20 @@ def get_token() -> Union[Response, Tuple[Response, int]]:
 def forgot_password() -> Union[Response, Tuple[Response, int]]:
     validated = response_body_validator(model.ResetPasswordRequest)
 
-    otp_key = RedisKeys.reset_password(validated.email)
     # if otp already in cache than need to wait 2 minutes
-    stored_otp = redis_client.get(otp_key)
-    if stored_otp:
-        logging.warning(f"Too many reset password request for {validated.email}")
-        raise OtpRetryLimitError()
+    otp_key = RedisKeys.reset_password(validated.email)
+    otp = reserve_otp(otp_key, validated.email)
 
     # check if the user registered
-    if not User.check_email(validated.email):
+    if not (
+        user_filter.might_contain(email_item(validated.email))
+        and User.check_email(validated.email)
+    ):
+        redis_client.delete(otp_key)
         logging.warning(f"User not found for reset password. email={validated.email}")
         raise UserNotFoundError()
 
-    # Generate OTP and send it
-    otp = generate_otp()
-    send_otp(otp, validated.email)
-
-    # if email sent than store the otp with email for 2 minutes
-    redis_client.setex(otp_key, 60 * 2, otp)
-
+    deliver_otp(otp_key, otp, validated.email)
     return jsonify({"message": "OTP sent to email"}), 200
 
 
@@ -163,6 +253,7 @@ def verify_reset_otp() -> Union[Response, Tuple[Response, int]]:
 
     # check stored otp for given email in redis cache
     stored_otp = redis_client.get(otp_key)
+    count_lookup(otp_key, stored_otp is not None)
     if not stored_otp or stored_otp != validated.otp:
         raise OtpError()
 
@@ -177,18 +268,20 @@ def change_password() -> Union[Response, Tuple[Response, int]]:
 
     # check stored otp for given email in redis cache
     stored_otp = redis_client.get(otp_key)
+    count_lookup(otp_key, stored_otp is not None)
     if not stored_otp or stored_otp != validated.otp:
         raise OtpError()
 
     try:
         # store new password in database
         user = User.query.filter_by(email=validated.email).first()
-        hashed_pass = bcrypt.generate_password_hash(
-            validated.password, rounds=13
-        ).decode("utf-8")
+        hashed_pass = hasher.generate_password_hash(validated.password)
         user.password = hashed_pass
+
+        # the otp is used up, and drop the cached record used by login_required
+        on_commit(db.session, lambda pipe: pipe.unlink(otp_key))
+        invalidate(db.session, RedisKeys.principal(user.id))
         db.session.commit()
-        redis_client.delete(validated.email)
     except Exception as e:
         logging.error(
             f"Failed to change password for email={validated.email}. Error: {str(e)}"
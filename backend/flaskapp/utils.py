@@ -1,13 +1,25 @@
 import jwt
+import gzip
+import json
+import time
+import base64
+import hashlib
 import logging
+from datetime import datetime
+from typing import NamedTuple
 from flask import Flask
 from functools import wraps
+from flaskapp import db
+from flaskapp.caching import LocalCache, RedisKeys, get_or_set, redis_client
+from flaskapp.config import Config
 from flaskapp.db_models import User
-from flask import request, current_app, jsonify
+from flaskapp.timing import phase
+from flask import request, current_app, jsonify, Response
 from pydantic import ValidationError
 from werkzeug.exceptions import HTTPException
 from flaskapp.exceptions import (
     RequestJsonError,
+    InvalidCursorError,
     TokenMissingError,
     TokenExpiredError,
     TokenInvalidError,
@@ -15,6 +27,7 @@ from flaskapp.exceptions import (
     UserNotFoundError,
     InternalServerError,
     ForbiddenAuthError,
+    RateLimitError,
 )
 
 
@@ -23,19 +36,157 @@ def register_error_handlers(app: Flask):
     @app.errorhandler(HTTPException)
     def handle_http_exception(e):
         response = {"error": e.description}
-        return jsonify(response), e.code
+        # extra headers like Retry-After, the body is always json
+        headers = [
+            (name, value)
+            for name, value in e.get_headers()
+            if name.lower() != "content-type"
+        ]
+        return jsonify(response), e.code, headers
+
+
+# address of the caller, used as the key of per client limits. Behind
+# trusted_hops reverse proxies it is the address the outermost trusted proxy
+# appended to X-Forwarded-For, the same value werkzeug's ProxyFix picks
+def resolve_client_ip(environ: dict, trusted_hops: int) -> str:
+    remote_addr = environ.get("REMOTE_ADDR") or "unknown"
+    if trusted_hops <= 0:
+        return remote_addr
+
+    forwarded = [
+        address.strip()
+        for address in environ.get("HTTP_X_FORWARDED_FOR", "").split(",")
+        if address.strip()
+    ]
+    # fewer addresses than proxies, the header did not come from them
+    if len(forwarded) < trusted_hops:
+        return remote_addr
+    return forwarded[-trusted_hops]
+
+
+def client_ip() -> str:
+    return resolve_client_ip(
+        request.environ, current_app.config["PROXY_TRUSTED_HOPS"]
+    )
 
 
 # take pydantic model and validate a request
 def response_body_validator(validator):
     try:
-        validated = validator(**request.get_json())
+        with phase("validate"):
+            validated = validator(**request.get_json())
         return validated
     except ValidationError as e:
         logging.error(f"Invalid request body. Error: {str(e)}")
         raise RequestJsonError()
 
 
+# serialized exactly like jsonify, so the bytes can be cached and served as is
+def json_body(data) -> bytes:
+    with phase("serialize"):
+        return f"{current_app.json.dumps(data)}\n".encode()
+
+
+def json_response(body: bytes, status: int = 200) -> Response:
+    return current_app.response_class(
+        body, status=status, mimetype=current_app.json.mimetype
+    )
+
+
+# serve a cached body, a compressed body is sent as is when the client accepts gzip
+def cached_json_response(body: bytes, compressed: bool) -> Response:
+    if not compressed:
+        response = json_response(body)
+    elif request.accept_encodings["gzip"]:
+        response = json_response(body)
+        response.content_encoding = "gzip"
+    else:
+        with phase("serialize"):
+            body = gzip.decompress(body)
+        response = json_response(body)
+
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+# opaque keyset pagination cursor for (date_created, id) ordered lists
+def encode_cursor(date_created: datetime, item_id: int) -> str:
+    raw = f"{date_created.isoformat()}|{item_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        date_created, item_id = base64.urlsafe_b64decode(padded).decode().split("|")
+        return datetime.fromisoformat(date_created), int(item_id)
+    except Exception:
+        logging.warning(f"Invalid pagination cursor={cursor}")
+        raise InvalidCursorError()
+
+
+class Principal(NamedTuple):
+    """Slim record of the authenticated user, passed to protected routes."""
+
+    id: int
+    username: str
+    email: str
+
+
+# decoded claims per token hash, claims of a signed token never change
+token_cache = LocalCache(
+    max_items=Config.PRINCIPAL_CACHE_MAX_ITEMS,
+    max_bytes=Config.PRINCIPAL_CACHE_MAX_ITEMS * 256,
+    ttl=Config.PRINCIPAL_CACHE_TTL,
+    family="token",
+)
+
+
+def init_token_cache(app: Flask) -> None:
+    max_items = app.config["PRINCIPAL_CACHE_MAX_ITEMS"]
+    ttl = app.config["PRINCIPAL_CACHE_TTL"]
+    token_cache.configure(max_items, max_items * 256, ttl)
+
+
+def decode_token(token: str) -> dict:
+    token_key = hashlib.sha256(token.encode()).hexdigest()
+    cached_claims = token_cache.get(token_key)
+    if cached_claims is None:
+        claims = jwt.decode(
+            token, current_app.config["SECRET_KEY"], algorithms=["HS256"]
+        )
+        # a token without an expiry is not cached, it could never be dropped
+        if claims.get("exp") is not None:
+            token_cache.set(token_key, json.dumps(claims).encode())
+        return claims
+
+    # same expiry check as jwt.decode
+    claims = json.loads(cached_claims)
+    if claims.get("exp", 0) <= time.time():
+        raise jwt.ExpiredSignatureError()
+    return claims
+
+
+# user record cached in redis and in the local cache of every worker,
+# dropped on password change
+def get_principal(user_id: int) -> Principal:
+    def load() -> bytes:
+        user = (
+            db.session.query(User.id, User.username, User.email)
+            .filter_by(id=user_id)
+            .first()
+        )
+        if not user:
+            logging.error(f"User not found for id={user_id}")
+            raise UserNotFoundError()
+        return json.dumps(user._asdict()).encode()
+
+    cache_key = RedisKeys.principal(user_id)
+    ttl = current_app.config["PRINCIPAL_CACHE_TTL"]
+    principal = get_or_set(cache_key, load, ttl=ttl)
+    return Principal(**json.loads(principal))
+
+
 # protected route
 def login_required(f):
     @wraps(f)
@@ -57,14 +208,8 @@ def login_required(f):
             raise TokenMissingError()
 
         try:
-            data = jwt.decode(
-                token, current_app.config["SECRET_KEY"], algorithms=["HS256"]
-            )
-
-            current_user = User.query.filter_by(id=data.get("id")).first()
-            if not current_user:
-                logging.error(f"User not found for token={token}")
-                raise UserNotFoundError()
+            data = decode_token(token)
+            current_user = get_principal(data.get("id"))
         except UserNotFoundError:
             raise
         except jwt.ExpiredSignatureError:
@@ -93,3 +238,56 @@ def logout_required(f):
         return f(*args, **kwargs)
 
     return inner
+
+
+# refill the bucket for the time passed and take one token, returns 0 when
+# the request is allowed, otherwise the milliseconds until a token is free
+TOKEN_BUCKET_SCRIPT = redis_client.register_script(
+    """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local time = redis.call("TIME")
+    local now = time[1] * 1000 + math.floor(time[2] / 1000)
+
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - ts) / 1000 * rate)
+
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = math.ceil((1 - tokens) / rate * 1000)
+    end
+    redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+    redis.call("PEXPIRE", KEYS[1], math.ceil(capacity / rate * 1000))
+    return wait
+    """
+)
+
+
+# limit a route per client ip with a policy from Config.RATE_LIMITS
+def rate_limit(policy: str):
+    def decorator(f):
+        @wraps(f)
+        def inner(*args, **kwargs):
+            capacity, rate = current_app.config["RATE_LIMITS"][policy]
+            try:
+                wait = TOKEN_BUCKET_SCRIPT(
+                    keys=[RedisKeys.rate_limit(policy, client_ip())],
+                    args=[capacity, rate],
+                )
+            except Exception as e:
+                # fail open, an unavailable redis must not take the api down
+                logging.error(f"Rate limit check failed. Error: {str(e)}")
+                wait = 0
+
+            if wait:
+                logging.warning(f"Rate limit {policy} reached for ip={client_ip()}")
+                raise RateLimitError(retry_after=-(-wait // 1000))
+            return f(*args, **kwargs)
+
+        return inner
+
+    return decorator
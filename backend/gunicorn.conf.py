@@ -0,0 +1,105 @@
+# gunicorn settings, loaded by `gunicorn wsgi:app` started from this directory
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+# nothing of flaskapp is imported here: the gevent patch and the prometheus
+# directory below must be in place before the preloaded app imports the
+# stdlib modules gevent patches and prometheus_client
+
+# gthread (default) or gevent, gevent needs `pip install gevent psycogreen`
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+
+if worker_class == "gevent":
+    # patched before the app is preloaded, psycopg2 yields to other greenlets
+    from gevent import monkey
+
+    monkey.patch_all()
+
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
+
+# prometheus multiprocess mode, set before the preloaded app imports
+# prometheus_client. Every worker writes its metrics to files in this
+# directory and /metrics adds them up.
+prometheus_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "prometheus")
+)
+# metric files of a previous run
+shutil.rmtree(prometheus_dir, ignore_errors=True)
+os.makedirs(prometheus_dir)
+
+from dotenv import load_dotenv  # noqa: E402
+
+# the database settings of .env, read with the same defaults as Config
+load_dotenv()
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+
+# gthread only, DB_POOL_SIZE defaults to the same value
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", 1000))
+
+# every worker holds up to DB_POOL_SIZE + DB_MAX_OVERFLOW database connections,
+# workers * that has to stay below postgres max_connections (DB_MAX_CONNECTIONS),
+# with some left for the counters and mailer services and maintenance sessions
+db_pool_size = int(os.getenv("DB_POOL_SIZE", threads))
+db_max_overflow = int(os.getenv("DB_MAX_OVERFLOW", 2))
+db_max_connections = int(os.getenv("DB_MAX_CONNECTIONS", 100))
+connections_per_worker = db_pool_size + db_max_overflow
+reserved_connections = 10
+max_workers = max(
+    (db_max_connections - reserved_connections) // connections_per_worker, 1
+)
+
+# the threads of a worker serve the concurrent requests, one worker per core
+workers = int(
+    os.getenv("GUNICORN_WORKERS", min(multiprocessing.cpu_count() + 1, max_workers))
+)
+
+# the app is imported once in the master, workers share its memory pages
+preload_app = True
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+graceful_timeout = 30
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+backlog = int(os.getenv("GUNICORN_BACKLOG", 2048))
+
+# workers are replaced after this many requests, jitter keeps them from
+# restarting all at once
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 100))
+
+
+def on_starting(server):
+    """Warn when the workers can open more connections than postgres allows."""
+    if workers > max_workers:
+        server.log.warning(
+            f"{workers} workers can open {workers * connections_per_worker} "
+            f"database connections, DB_MAX_CONNECTIONS is {db_max_connections}"
+        )
+
+
+def child_exit(server, worker):
+    """Remove the live gauges of a stopped worker from /metrics."""
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    """Drop database connections inherited from the master."""
+    from flaskapp.pools import reset_after_fork
+
+    # redis-py pools, the invalidation listener and the hash pool check the
+    # pid themselves and reconnect in the worker
+    reset_after_fork(worker.app.wsgi())
+
+
+def post_worker_init(worker):
+    """Open database and redis connections before the first request."""
+    from flaskapp.pools import warm_up
+
+    warm_up(worker.wsgi)
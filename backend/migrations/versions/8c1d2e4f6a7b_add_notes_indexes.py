@@ -0,0 +1,28 @@
+"""add notes indexes
+
+Revision ID: 8c1d2e4f6a7b
+Revises: 355be7191df1
+Create Date: 2026-10-18 08:24:02.113406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1d2e4f6a7b'
+down_revision = '355be7191df1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a user's notes newest first: note lists, keyset pagination and the
+    # User.notes relationship (user_id is the leading column)
+    with op.batch_alter_table('notes', schema=None) as batch_op:
+        batch_op.create_index('ix_notes_user_id_date_created_id', ['user_id', sa.literal_column('date_created DESC'), sa.literal_column('id DESC')], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('notes', schema=None) as batch_op:
+        batch_op.drop_index('ix_notes_user_id_date_created_id')
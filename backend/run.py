@@ -1,10 +1,8 @@
-from flaskapp import create_app, db
+from flaskapp import create_app
 from flaskapp.config import DevelopmentConfig
 
+# the schema is created and upgraded by `flask --app run db upgrade`
 app = create_app(DevelopmentConfig)
 
-with app.app_context():
-    db.create_all()
-
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
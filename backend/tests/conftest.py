@@ -1,14 +1,12 @@
 import os
 import pytest
-from dotenv import load_dotenv
-from flaskapp import bcrypt
+from flaskapp import hasher
 from flaskapp.db_models import User
 from flaskapp import create_app, db
 from flaskapp.db_models import Notes
+from sqlalchemy import insert
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-load_dotenv()
-
 
 class TestConfig:
     SECRET_KEY = os.getenv("SECRET_KEY")
@@ -16,19 +14,59 @@ class TestConfig:
 
     TESTING = True
     SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
+    MAX_CONTENT_LENGTH = 256 * 1024
+    DB_POOL_SIZE = 4
+    DB_MAX_OVERFLOW = 2
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_RECYCLE = 30 * 60
+    DB_STATEMENT_TIMEOUT = 10000
+    REPLICA_MAX_LAG = 5
+    REPLICA_LAG_CHECK_INTERVAL = 5
+    REPLICA_STICKY_SECONDS = 10
+    REPLICA_CACHE_TTL = 30
     MAIL_SUPPRESS_SEND = True
+    MAIL_BATCH_SIZE = 50
+    MAIL_MAX_ATTEMPTS = 5
+    MAIL_RETRY_BACKOFF = 5
+    MAIL_POLL_TIMEOUT = 1
+    MAIL_IDLE_TIMEOUT = 60
+    MAIL_WORKER_TTL = 60
+    REQUEST_TIMING = False
+    METRICS_TOKEN = "metrics-token"
 
     # jwt
     JWT_TIMEOUT_MINUTES = int(os.getenv("JWT_TIMEOUT_MINUTES"))
+    PRINCIPAL_CACHE_TTL = 60
+    PRINCIPAL_CACHE_MAX_ITEMS = 1000
+
+    # password hashing
+    BCRYPT_LOG_ROUNDS = 4
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_MAX_PENDING = 8
+    PASSWORD_HASH_TIMEOUT = 10
 
     # user
     MAX_NAME_LENGTH = 20
     MIN_NAME_LENGTH = 3
     OTP_LENGTH = 6
+    OTP_TTL = 60 * 2  # seconds
+    OTP_WINDOW = 60 * 60  # seconds, sliding window for the limits below
+    OTP_MAX_PER_IP = 20
+    OTP_MAX_PER_EMAIL = 5
     MIN_PASS_LENGTH = 8
     MAX_PASS_LENGTH = 20
     PASSWORD_REGEX = r"^(?=.*[a-z])(?=.*[A-Z])(?=.*\d)[a-zA-Z\d]{8,20}$"
 
+    # reverse proxies in front of the app (nginx)
+    PROXY_TRUSTED_HOPS = 1
+
+    # rate limits per client ip, token bucket of (capacity, tokens per second)
+    RATE_LIMITS = {
+        "log-in": (10, 10 / 60),
+        "sign-up": (5, 5 / 60),
+        "single-note": (30, 1),
+    }
+
     # note
     MAX_NOTE_ID_LENGTH = 7
     MIN_TITLE_LENGTH = 1
@@ -38,6 +76,25 @@ class TestConfig:
     MIN_PIN_LENGTH = 3
     MAX_PIN_LENGTH = 8
 
+    # public profile
+    PROFILE_NOTES_PER_PAGE = 20
+    PROFILE_CACHE_MAX_PAGES = 50  # cached pages per user
+    PROFILE_CACHE_TTL = 60 * 60 * 24  # seconds
+
+    # cache
+    L1_CACHE_MAX_ITEMS = 1024
+    L1_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    L1_CACHE_TTL = 30
+    CACHE_LOCK_LEASE = 5000
+    CACHE_LOCK_WAIT = 3
+    COUNTER_RECONCILE_LEASE = 60 * 1000
+    CACHE_TTL_JITTER = 0.1
+    CACHE_EARLY_REFRESH_BETA = 1.0
+    CACHE_GENERATION_TTL = PROFILE_CACHE_TTL * 2
+    CACHE_COMPRESS_MIN_BYTES = 1024
+    CACHE_COMPRESS_LEVEL = 6
+    NEGATIVE_CACHE_TTL = 30
+
 
 @pytest.fixture(scope="session")
 def app():
@@ -52,6 +109,7 @@ def app():
 
 @pytest.fixture(scope="function")
 def db_session(app):
+    session = db.session
     with app.app_context():
         connection = db.engine.connect()
         transaction = connection.begin()
@@ -64,15 +122,21 @@ def db_session(app):
         Session.remove()
         transaction.rollback()
         connection.close()
+        db.session = session
 
 
 @pytest.fixture()
 def redis_clean():
-    from flaskapp.caching import redis_client
+    from flaskapp.caching import redis_client, local_cache
+    from flaskapp.utils import token_cache
 
     redis_client.flushdb()
+    local_cache.clear()
+    token_cache.clear()
     yield redis_client
     redis_client.flushdb()
+    local_cache.clear()
+    token_cache.clear()
 
 
 @pytest.fixture()
@@ -81,8 +145,8 @@ def client(app, db_session, redis_clean):
 
 
 @pytest.fixture(scope="function")
-def test_user_1():
-    hashed_pass = bcrypt.generate_password_hash("string", rounds=13).decode("utf-8")
+def test_user_1(app):
+    hashed_pass = hasher.generate_password_hash("string")
     return User(
         email="test1@example.com",
         username="test1",
@@ -103,8 +167,8 @@ def auth_headers_1(client, db_session, test_user_1):
 
 
 @pytest.fixture(scope="function")
-def test_user_2():
-    hashed_pass = bcrypt.generate_password_hash("string", rounds=13).decode("utf-8")
+def test_user_2(app):
+    hashed_pass = hasher.generate_password_hash("string")
     return User(
         email="test2@example.com",
         username="test2",
@@ -135,3 +199,53 @@ def test_note_1(db_session, test_user_1):
         pin="pin",
         user_id=test_user_1.id,
     )
+
+
+def seed(engine, title: str = "title") -> None:
+    """Create the tables with user id 1 "test1" and its note id 1."""
+    user = {"id": 1, "username": "test1", "email": "t@example.com", "password": "x"}
+    note = {"id": 1, "title": title, "text": "text", "pin": None, "user_id": 1}
+
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(User), user)
+        connection.execute(insert(Notes), note)
+
+
+@pytest.fixture(scope="function")
+def make_app(tmp_path):
+    """
+    Create apps from TestConfig with the given config overrides, on a sqlite
+    file by default. seed=True fills the primary database, see seed.
+    """
+    apps = []
+
+    def make(seed_db: bool = False, **overrides):
+        overrides.setdefault(
+            "SQLALCHEMY_DATABASE_URI", f"sqlite:///{tmp_path / 'app.db'}"
+        )
+        flask_app = create_app(type("AppConfig", (TestConfig,), overrides))
+        apps.append(flask_app)
+        if seed_db:
+            with flask_app.app_context():
+                seed(db.engine)
+        return flask_app
+
+    yield make
+
+    for flask_app in apps:
+        with flask_app.app_context():
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+    # init_app registered an empty metadata for every bind on the shared db
+    for key in [key for key in db.metadatas if key is not None]:
+        db.metadatas.pop(key)
+
+
+@pytest.fixture(scope="function")
+def timed_app(make_app, redis_clean):
+    """App with REQUEST_TIMING on, a user and a note in a sqlite file."""
+    flask_app = make_app(seed_db=True, REQUEST_TIMING=True)
+    with flask_app.app_context():
+        yield flask_app
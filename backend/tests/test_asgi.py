@@ -0,0 +1,225 @@
+import json
+import asyncio
+from prometheus_client import REGISTRY
+from flaskapp.asgi import AsgiApp
+from flaskapp.caching import invalidation_listener
+from flaskapp.main import service
+
+
+def serve(flask_app, *requests) -> list:
+    """Send (method, path, json body[, headers]) requests through one ASGI app."""
+
+    async def call(asgi_app, method, path, payload, extra_headers=()):
+        path, _, query = path.partition("?")
+        body = json.dumps(payload).encode() if payload is not None else b""
+        scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": method,
+            "path": path,
+            "root_path": "",
+            "query_string": query.encode(),
+            "headers": [
+                (b"host", b"testserver"),
+                (b"origin", b"http://example.com"),
+                (b"content-type", b"application/json"),
+                (b"accept-encoding", b"gzip"),
+                (b"content-length", str(len(body)).encode()),
+                *extra_headers,
+            ],
+            "client": ("127.0.0.1", 1234),
+            "server": ("testserver", 80),
+        }
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        await asgi_app(scope, receive, send)
+        headers = {k.decode(): v.decode() for k, v in sent[0]["headers"]}
+        body = b"".join(m.get("body", b"") for m in sent[1:])
+        return sent[0]["status"], headers, body
+
+    async def run():
+        asgi_app = AsgiApp(flask_app)
+        try:
+            return [await call(asgi_app, *request) for request in requests]
+        finally:
+            await asgi_app.redis.aclose()
+
+    return asyncio.run(run())
+
+
+def test_profile_hit_on_event_loop(app, db_session, redis_clean, test_note_1):
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    # the miss is answered by the flask app and fills the cache
+    request = ("GET", "/api-v1/main/user-profile/test1/", None)
+    [(status, headers, body)] = serve(app, request)
+    assert status == 200
+    assert json.loads(body)["notes"][0]["title"] == test_note_1.title
+
+    def fail(username):
+        raise AssertionError("flask view called on a cache hit")
+
+    service_view = service.get_user_note_list
+    service.get_user_note_list = fail
+    try:
+        [(hit_status, hit_headers, hit_body)] = serve(app, request)
+    finally:
+        service.get_user_note_list = service_view
+
+    assert hit_status == 200
+    assert hit_body == body
+    assert hit_headers == headers
+
+
+def test_single_note_pin(app, db_session, redis_clean, test_note_1):
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    note_id = str(test_note_1.id)
+    payload = {"username": "test1", "note_id": note_id, "pin": "pin"}
+    responses = serve(
+        app,
+        ("POST", "/api-v1/main/single-note/", payload),
+        ("POST", "/api-v1/main/single-note/", payload),
+        ("POST", "/api-v1/main/single-note/", {**payload, "pin": None}),
+        ("POST", "/api-v1/main/single-note/", {**payload, "pin": "wrong"}),
+        ("POST", "/api-v1/main/single-note/", {**payload, "note_id": "999"}),
+    )
+    miss, hit, no_pin, wrong_pin, not_found = responses
+
+    assert miss[0] == hit[0] == 200
+    assert hit[2] == miss[2]
+    assert json.loads(hit[2])["title"] == test_note_1.title
+
+    # errors come from the flask app, with the same bodies as under wsgi
+    assert no_pin[0] == 401
+    assert wrong_pin[0] == 403
+    assert not_found[0] == 404
+
+
+def test_single_note_rate_limit(app, db_session, redis_clean, test_note_1):
+    test_note_1.pin = None
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    capacity, _ = app.config["RATE_LIMITS"]["single-note"]
+    payload = {"username": "test1", "note_id": str(test_note_1.id)}
+    request = ("POST", "/api-v1/main/single-note/", payload)
+    responses = serve(app, *[request] * (capacity + 1))
+
+    assert [status for status, _, _ in responses[:capacity]] == [200] * capacity
+    status, headers, _ = responses[-1]
+    assert status == 429
+    assert int(headers["retry-after"]) >= 1
+
+
+# every client behind the nginx proxy has its own bucket
+def test_single_note_rate_limit_behind_proxy(app, db_session, redis_clean, test_note_1):
+    test_note_1.pin = None
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    capacity, _ = app.config["RATE_LIMITS"]["single-note"]
+    payload = {"username": "test1", "note_id": str(test_note_1.id)}
+
+    def request(client):
+        headers = [(b"x-forwarded-for", client.encode())]
+        return ("POST", "/api-v1/main/single-note/", payload, headers)
+
+    responses = serve(
+        app,
+        *[request("203.0.113.1")] * (capacity + 1),
+        request("203.0.113.2"),
+    )
+    assert responses[capacity][0] == 429
+    assert responses[-1][0] == 200
+
+
+def test_gzip_hit(app, db_session, redis_clean, test_user_1):
+    db_session.add(test_user_1)
+    db_session.commit()
+    db_session.add_all(
+        [
+            service.Notes(title=f"Note title {i}", text="text", user_id=test_user_1.id)
+            for i in range(20)
+        ]
+    )
+    db_session.commit()
+
+    request = ("GET", "/api-v1/main/user-profile/test1/", None)
+    miss, hit = serve(app, request, request)
+    assert miss[1]["content-encoding"] == hit[1]["content-encoding"] == "gzip"
+    assert hit[2] == miss[2]
+
+
+# hits answered on the event loop are measured like flask requests
+def test_fast_path_metrics(app, db_session, redis_clean, test_note_1):
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    labels = {"endpoint": "main.single_note", "method": "POST", "status": "200"}
+
+    def count():
+        name = "http_request_duration_seconds_count"
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    before = count()
+    payload = {"username": "test1", "note_id": str(test_note_1.id), "pin": "pin"}
+    serve(app, *[("POST", "/api-v1/main/single-note/", payload)] * 4)
+    assert count() == before + 4
+
+
+def test_fast_path_server_timing(timed_app):
+    payload = {"username": "test1", "note_id": "1"}
+    request = ("POST", "/api-v1/main/single-note/", payload)
+    miss, hit = serve(timed_app, request, request)
+    assert "db" in miss[1]["server-timing"]
+    phases = dict(
+        metric.split(";dur=") for metric in hit[1]["server-timing"].split(", ")
+    )
+    assert {"redis", "total"} <= phases.keys()
+    assert "db" not in phases
+
+
+def test_request_body_limits(app, redis_clean):
+    payload = {"username": "test1", "note_id": "1", "pin": "x" * 300 * 1024}
+    too_large, other_route = serve(
+        app,
+        ("POST", "/api-v1/main/single-note/", payload),
+        ("POST", "/api-v1/users/log-in/", {"email": "a@example.com", "password": "x"}),
+    )
+    assert too_large[0] == 413
+    # bodies of the other routes are streamed to the flask app
+    assert other_route[0] == 404
+
+
+def test_lifespan(app):
+    async def run():
+        asgi_app = AsgiApp(app)
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        await asgi_app({"type": "lifespan"}, receive, send)
+        return asgi_app, sent
+
+    asgi_app, sent = asyncio.run(run())
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+    assert invalidation_listener.alive
+    # one thread per database connection
+    assert asgi_app.executor._max_workers == 6
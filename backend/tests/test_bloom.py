@@ -0,0 +1,74 @@
+from sqlalchemy import event
+from flaskapp import db
+from flaskapp.bloom import user_filter, name_item, email_item
+from flaskapp.caching import RedisKeys, redis_client
+
+
+def test_missing_filter_falls_back_to_db(redis_clean):
+    assert user_filter.might_contain(name_item("anyone"))
+
+    # an add never creates a partial filter
+    user_filter.add(name_item("anyone"))
+    assert not redis_client.exists(RedisKeys.USER_FILTER)
+
+
+def test_rebuild_command(app, db_session, redis_clean, test_user_1):
+    db_session.add(test_user_1)
+    db_session.commit()
+
+    result = app.test_cli_runner().invoke(args=["rebuild-user-filter"])
+    assert result.output == "Added 2 usernames and emails\n"
+
+    assert user_filter.might_contain(name_item(" Test1 "))
+    assert user_filter.might_contain(email_item(test_user_1.email))
+    assert not user_filter.might_contain(name_item("free-name"))
+    assert not redis_client.exists(user_filter.building_key)
+
+
+def test_add_during_rebuild(redis_clean):
+    user_filter.rebuild([])
+
+    # a registration while the new filter is built lands in both
+    redis_client.setbit(user_filter.building_key, user_filter.size - 1, 0)
+    user_filter.add(name_item("new"))
+    redis_client.rename(user_filter.building_key, user_filter.key)
+    assert user_filter.might_contain(name_item("new"))
+
+
+def test_sign_up_skips_db_for_free_names(client, db_session, test_user_1):
+    db_session.add(test_user_1)
+    db_session.commit()
+    user_filter.rebuild([name_item("test1"), email_item(test_user_1.email)])
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        payload = {"username": "free-name", "email": "free@example.com"}
+        response = client.post("/api-v1/users/sign-up/", json=payload)
+        assert response.status_code == 200
+        assert statements == []
+
+        # possible hit, the database decides
+        payload = {"username": "test1", "email": "other@example.com"}
+        response = client.post("/api-v1/users/sign-up/", json=payload)
+        assert response.status_code == 409
+        assert len(statements) == 1
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    # registered users are added to the filter
+    redis_client.set(RedisKeys.sign_up("free@example.com"), "123456")
+    payload = {
+        "username": "free-name",
+        "email": "free@example.com",
+        "password": "Asdf1111",
+        "otp": "123456",
+    }
+    response = client.post("/api-v1/users/verify/", json=payload)
+    assert response.status_code == 201
+    assert user_filter.might_contain(name_item("free-name"))
+    assert user_filter.might_contain(email_item("free@example.com"))
@@ -0,0 +1,216 @@
+import gzip
+import json
+import time
+import threading
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from flaskapp.config import Config
+from flaskapp.caching import (
+    LocalCache,
+    RedisKeys,
+    bump_generation,
+    get_generation,
+    get_or_set,
+    invalidate,
+    jittered_ttl,
+    local_cache,
+    pack_entry,
+    redis_client,
+    should_refresh_early,
+    unpack_entry,
+)
+
+
+# the cache settings are read from the app config
+@pytest.fixture(autouse=True)
+def app_context(app):
+    with app.app_context():
+        yield
+
+
+class TestLocalCache:
+    def test_lru_eviction_by_items(self):
+        cache = LocalCache(max_items=2, max_bytes=1024, ttl=60)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+
+        assert cache.get("a") == "1"
+        assert cache.get("b") is None
+        assert cache.get("c") == "3"
+
+    def test_eviction_by_bytes(self):
+        cache = LocalCache(max_items=10, max_bytes=10, ttl=60)
+        cache.set("a", "x" * 6)
+        cache.set("b", "x" * 6)
+
+        assert cache.get("a") is None
+        assert cache.get("b") == "x" * 6
+        assert cache.size == 6
+
+        # a single value bigger than the cap is never stored
+        cache.set("c", "x" * 11)
+        assert cache.get("c") is None
+
+    def test_ttl(self):
+        cache = LocalCache(max_items=10, max_bytes=1024, ttl=0)
+        cache.set("a", "1")
+        time.sleep(0.01)
+        assert cache.get("a") is None
+        assert cache.size == 0
+
+    def test_stale_set_after_invalidation(self):
+        cache = LocalCache(max_items=10, max_bytes=1024, ttl=60)
+        generation = cache.generation
+        cache.delete("a")
+        cache.set("a", "stale", generation=generation)
+        assert cache.get("a") is None
+
+
+def test_get_or_set_populates_local_cache(redis_clean):
+    assert get_or_set("key", lambda: b"value") == b"value"
+    assert redis_client.get("key") == "value"
+
+    # served from the local cache without touching redis
+    redis_client.delete("key")
+    assert get_or_set("key", lambda: b"other") == b"value"
+
+
+def test_invalidation_from_other_worker(redis_clean):
+    assert get_or_set("key", lambda: b"value") == b"value"
+
+    # another worker deletes the key and publishes the invalidation
+    redis_client.delete("key")
+    redis_client.publish(RedisKeys.INVALIDATION_CHANNEL, json.dumps(["key"]))
+
+    for _ in range(50):
+        if local_cache.get("key") is None:
+            break
+        time.sleep(0.05)
+    assert get_or_set("key", lambda: b"new") == b"new"
+
+
+def test_get_or_set_single_flight(app, redis_clean):
+    calls = []
+
+    def slow_compute():
+        calls.append(1)
+        time.sleep(0.3)
+        return b"value"
+
+    results = []
+
+    def read():
+        with app.app_context():
+            results.append(get_or_set("key", slow_compute))
+
+    threads = [threading.Thread(target=read) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [b"value"] * 10
+    assert redis_client.get(RedisKeys.lock("key")) is None
+
+
+def test_get_or_set_serves_stale_while_locked(redis_clean, monkeypatch):
+    redis_client.set("key", "stale", ex=60)
+    # another worker is already refreshing the key
+    redis_client.set(RedisKeys.lock("key"), "other-worker")
+    monkeypatch.setattr("flaskapp.caching.should_refresh_early", lambda *args: True)
+
+    assert get_or_set("key", lambda: b"fresh", ttl=60) == b"stale"
+
+    # the lock is free, this request refreshes the key before it expires
+    redis_client.delete(RedisKeys.lock("key"))
+    assert get_or_set("key", lambda: b"fresh", ttl=60) == b"fresh"
+    assert redis_client.get("key") == "fresh"
+
+
+def test_ttl_jitter_and_early_refresh():
+    ttls = {jittered_ttl(3600) for _ in range(100)}
+    assert all(3240 <= ttl <= 3960 for ttl in ttls)
+    assert len(ttls) > 1
+
+    assert should_refresh_early("key", 0)
+    assert not should_refresh_early("key", 60 * 60 * 1000)
+    # keys without expiry are never refreshed early
+    assert not should_refresh_early("key", -1)
+
+
+def test_pack_entry():
+    entry = pack_entry(b'{"title": "x"}', meta="pïn".encode())
+    assert unpack_entry(entry) == ("pïn".encode(), b'{"title": "x"}', False)
+    assert unpack_entry(pack_entry(b"body")) == (b"", b"body", False)
+
+    # large bodies are stored compressed
+    body = b'{"text": "' + b"x" * 20000 + b'"}'
+    meta, compressed_body, compressed = unpack_entry(pack_entry(body, meta=b"pin"))
+    assert meta == b"pin"
+    assert compressed
+    assert len(compressed_body) < len(body) / 10
+    assert gzip.decompress(compressed_body) == body
+
+
+def test_invalidate_after_commit(redis_clean):
+    engine = create_engine("sqlite://")
+    redis_client.set("key", "value")
+    local_cache.set("key", b"value")
+
+    with Session(engine) as session:
+        session.execute(text("select 1"))
+        invalidate(session, "key")
+        assert redis_client.get("key") == "value"
+        session.commit()
+    assert redis_client.get("key") is None
+    assert local_cache.get("key") is None
+
+    # a rolled back transaction invalidates nothing
+    redis_client.set("key", "value")
+    with Session(engine) as session:
+        session.execute(text("select 1"))
+        invalidate(session, "key")
+        session.rollback()
+        session.commit()
+    assert redis_client.get("key") == "value"
+
+
+def test_generation(redis_clean):
+    engine = create_engine("sqlite://")
+    key = RedisKeys.user_generation("test1")
+
+    # a new counter starts from the current time, not from 0
+    started = get_generation(key)
+    assert started >= time.time_ns() // 1000 - 10**6
+    assert get_generation(key) == started
+    # reads of unknown owners leave no permanent keys
+    assert redis_client.ttl(key) > Config.PROFILE_CACHE_TTL
+
+    with Session(engine) as session:
+        session.execute(text("select 1"))
+        bump_generation(session, key)
+        session.commit()
+    assert local_cache.get(key) is None
+    assert get_generation(key) == started + 1
+    # a bump refreshes the expiry
+    redis_client.expire(key, 10)
+    with Session(engine) as session:
+        session.execute(text("select 1"))
+        bump_generation(session, key)
+        session.commit()
+    assert redis_client.ttl(key) > Config.PROFILE_CACHE_TTL
+    assert get_generation(key) == started + 2
+
+    # a lost counter never goes back to a generation that may be cached
+    redis_client.delete(key)
+    local_cache.clear()
+    with Session(engine) as session:
+        session.execute(text("select 1"))
+        bump_generation(session, key)
+        session.commit()
+    assert get_generation(key) > started + 2
+    assert redis_client.ttl(key) > Config.PROFILE_CACHE_TTL
@@ -0,0 +1,146 @@
+import json
+import time
+import socket
+import pytest
+from aiosmtpd.controller import Controller
+from flaskapp.caching import RedisKeys, redis_client
+from flaskapp.mailer import MailWorker, enqueue_mail
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class RecordingHandler:
+    """Local smtp stand-in, keeps every received message."""
+
+    def __init__(self):
+        self.messages = []
+        self.peers = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        self.peers.add(session.peer)
+        return "250 OK"
+
+
+@pytest.fixture()
+def smtp_server():
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port())
+    controller.start()
+    yield controller
+    controller.stop()
+
+
+@pytest.fixture()
+def smtp_app(make_app):
+    def make(port: int):
+        return make_app(
+            MAIL_SERVER="127.0.0.1",
+            MAIL_PORT=port,
+            MAIL_USE_SSL=False,
+            MAIL_USE_TLS=False,
+            MAIL_SUPPRESS_SEND=False,
+        )
+
+    return make
+
+
+def enqueue(count: int) -> None:
+    for i in range(count):
+        enqueue_mail("Subject", "noreply@demo.com", [f"user{i}@example.com"], "body")
+
+
+def test_sign_up_only_enqueues(client):
+    payload = {"username": "new_name", "email": "new@example.com"}
+    response = client.post("/api-v1/users/sign-up/", json=payload)
+    assert response.status_code == 200
+
+    job = json.loads(redis_client.lindex(RedisKeys.MAIL_QUEUE, 0))
+    assert job["recipients"] == ["new@example.com"]
+    assert job["expires"] > time.time()
+
+
+def test_worker_sends_batches_over_one_connection(redis_clean, smtp_server, smtp_app):
+    worker = MailWorker()
+    with smtp_app(smtp_server.port).app_context():
+        enqueue(3)
+        assert worker.run_once() == 3
+        enqueue(2)
+        assert worker.run_once() == 2
+        worker.close()
+
+    handler = smtp_server.handler
+    assert sorted(m.rcpt_tos[0] for m in handler.messages) == sorted(
+        [f"user{i}@example.com" for i in range(3)]
+        + [f"user{i}@example.com" for i in range(2)]
+    )
+    assert len(handler.peers) == 1
+    assert redis_client.llen(RedisKeys.MAIL_QUEUE) == 0
+    assert redis_client.llen(worker.processing) == 0
+
+
+def test_worker_retries_with_backoff(redis_clean, smtp_server, smtp_app):
+    worker = MailWorker()
+    enqueue(1)
+
+    # nothing listens on this port
+    with smtp_app(free_port()).app_context():
+        assert worker.run_once() == 1
+
+    [(raw, due)] = redis_client.zrange(RedisKeys.MAIL_RETRY, 0, -1, withscores=True)
+    assert json.loads(raw)["attempts"] == 1
+    assert due > time.time()
+    assert redis_client.llen(worker.processing) == 0
+
+    # not due yet
+    with smtp_app(smtp_server.port).app_context():
+        assert worker.run_once(timeout=0.1) == 0
+
+        redis_client.zadd(RedisKeys.MAIL_RETRY, {raw: 0})
+        assert worker.run_once() == 1
+        worker.close()
+
+    assert len(smtp_server.handler.messages) == 1
+    assert redis_client.zcard(RedisKeys.MAIL_RETRY) == 0
+
+
+def test_worker_drops_failed_and_expired_jobs(redis_clean, smtp_app, monkeypatch):
+    app = smtp_app(free_port())
+    monkeypatch.setitem(app.config, "MAIL_MAX_ATTEMPTS", 1)
+    worker = MailWorker()
+    enqueue(1)
+    enqueue_mail("Subject", "noreply@demo.com", ["late@example.com"], "body", ttl=1)
+    monkeypatch.setattr("flaskapp.mailer.time.time", lambda: 2e9)
+
+    with app.app_context():
+        assert worker.run_once() == 2
+
+    [failed] = redis_client.lrange(RedisKeys.MAIL_FAILED, 0, -1)
+    assert json.loads(failed)["recipients"] == ["user0@example.com"]
+    assert redis_client.zcard(RedisKeys.MAIL_RETRY) == 0
+    assert redis_client.llen(worker.processing) == 0
+
+
+# only the jobs of a worker without a heartbeat go back to the queue
+def test_recover_skips_live_workers(app, redis_clean):
+    crashed, live, starting = MailWorker(), MailWorker(), MailWorker()
+    enqueue(2)
+    crashed.heartbeat()
+    assert len(crashed.take_batch(1)) == 2
+    enqueue(1)
+    live.heartbeat()
+    assert len(live.take_batch(1)) == 1
+
+    starting.recover()
+    assert redis_client.llen(RedisKeys.MAIL_QUEUE) == 0
+
+    redis_client.delete(RedisKeys.mail_worker(crashed.id))
+    starting.recover()
+    assert redis_client.llen(RedisKeys.MAIL_QUEUE) == 2
+    assert redis_client.llen(crashed.processing) == 0
+    assert redis_client.llen(live.processing) == 1
+    assert redis_client.smembers(RedisKeys.MAIL_WORKERS) == {live.id}
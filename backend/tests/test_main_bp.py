@@ -1,6 +1,17 @@
+import gzip
+import threading
+from sqlalchemy import event
+from flaskapp import db
+from flaskapp.caching import RedisKeys, redis_client
 from flaskapp.db_models import Notes
 
 
+def wait_for_reconcile():
+    for thread in threading.enumerate():
+        if thread.name == "reconcile-counters":
+            thread.join()
+
+
 def test_homepage_stats(client, db_session, test_user_1):
     db_session.add(test_user_1)
     db_session.commit()
@@ -22,6 +33,23 @@ def test_homepage_stats(client, db_session, test_user_1):
         db_session.add(note)
     db_session.commit()
 
+    # no counters yet, the request does not wait for the recount
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if threading.current_thread() is threading.main_thread():
+            statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get("/api-v1/main/home/")
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code == 200
+    assert statements == []
+
+    # counted once in the background
+    wait_for_reconcile()
     response = client.get("/api-v1/main/home/")
     data = response.get_json()
 
@@ -77,6 +105,25 @@ def test_test_single_note_error(client, db_session, test_note_1, test_user_1):
     assert response.get_json()["error"] == "Invalid pin"
 
 
+# equal note ids share one cache entry, other ids are rejected
+def test_single_note_id_normalized(client, db_session, test_note_1, test_user_1):
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    for note_id in [str(test_note_1.id), f"0{test_note_1.id}", f" {test_note_1.id} "]:
+        payload = {"username": test_user_1.username, "note_id": note_id, "pin": "pin"}
+        response = client.post("/api-v1/main/single-note/", json=payload)
+        assert response.status_code == 200
+    assert redis_client.keys(RedisKeys.single_note("*")) == [
+        RedisKeys.single_note(test_note_1.id)
+    ]
+
+    for note_id in ["1e3", "-1", "abc"]:
+        payload = {"username": test_user_1.username, "note_id": note_id}
+        response = client.post("/api-v1/main/single-note/", json=payload)
+        assert response.status_code == 400
+
+
 # test user profile endpoint
 def test_user_profile(client, db_session, test_user_1):
     db_session.add(test_user_1)
@@ -103,8 +150,217 @@ def test_user_profile(client, db_session, test_user_1):
     assert response.status_code == 200
 
     data = response.get_json()
-    assert len(data) == 100
-    assert "id" in data[0]
-    assert "title" in data[0]
-    assert "dateCreated" in data[0]
-    assert "isLocked" in data[0]
+    assert len(data["notes"]) == 20
+    assert "id" in data["notes"][0]
+    assert "title" in data["notes"][0]
+    assert "dateCreated" in data["notes"][0]
+    assert "isLocked" in data["notes"][0]
+
+    # walk the remaining pages with the cursor
+    note_ids = [note["id"] for note in data["notes"]]
+    while data["nextCursor"]:
+        response = client.get(
+            f"/api-v1/main/user-profile/{test_user_1.username}/",
+            query_string={"after": data["nextCursor"]},
+        )
+        assert response.status_code == 200
+        data = response.get_json()
+        note_ids.extend(note["id"] for note in data["notes"])
+
+    assert len(note_ids) == 100
+    assert note_ids == sorted(note_ids, reverse=True)
+
+
+# cached pages per user are capped
+def test_user_profile_cache_cap(
+    client, db_session, redis_clean, test_user_1, monkeypatch
+):
+    db_session.add(test_user_1)
+    db_session.commit()
+    for i in range(1, 11):
+        db_session.add(Notes(title=f"title {i}", text="text", user_id=test_user_1.id))
+    db_session.commit()
+
+    monkeypatch.setitem(client.application.config, "PROFILE_NOTES_PER_PAGE", 2)
+    monkeypatch.setitem(client.application.config, "PROFILE_CACHE_MAX_PAGES", 3)
+
+    data = {"nextCursor": ""}
+    while data["nextCursor"] is not None:
+        response = client.get(
+            "/api-v1/main/user-profile/test1/",
+            query_string={"after": data["nextCursor"]},
+        )
+        data = response.get_json()
+
+    generation = redis_clean.get(RedisKeys.user_generation(test_user_1.username))
+    cache_key = RedisKeys.user_notes(test_user_1.username, generation)
+    assert redis_clean.hlen(cache_key) == 3
+    assert 0 < redis_clean.ttl(cache_key) <= 60 * 60 * 24 * 1.1
+
+    response = client.get("/api-v1/main/user-profile/test1/?after=invalid")
+    assert response.status_code == 400
+
+
+# homepage counters follow the write paths without recounting
+def test_homepage_stats_counters(client, db_session, test_note_1, auth_headers_1):
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    client.get("/api-v1/main/home/")
+    wait_for_reconcile()
+    data = client.get("/api-v1/main/home/").get_json()
+    char_count = len(test_note_1.title) + len(test_note_1.text)
+    assert data == {"totalUser": 1, "totalNotes": 1, "totalChar": char_count}
+
+    # notes added behind the service are only seen after reconciliation
+    db_session.add(Notes(title="title", text="text", user_id=test_note_1.user_id))
+    db_session.commit()
+
+    payload = {"title": "New title", "text": "New text", "pin": ""}
+    response = client.post(
+        "/api-v1/notes/new-note/", json=payload, headers=auth_headers_1
+    )
+    new_note_id = response.get_json()["id"]
+    char_count += len("New title") + len("New text")
+    data = client.get("/api-v1/main/home/").get_json()
+    assert data == {"totalUser": 1, "totalNotes": 2, "totalChar": char_count}
+
+    payload = {"title": "T", "text": "T", "pin": "", "note_id": new_note_id}
+    client.put("/api-v1/notes/update-note/", json=payload, headers=auth_headers_1)
+    char_count += 2 - len("New title") - len("New text")
+    data = client.get("/api-v1/main/home/").get_json()
+    assert data["totalChar"] == char_count
+
+    client.delete(f"/api-v1/notes/delete-note/{new_note_id}/", headers=auth_headers_1)
+    data = client.get("/api-v1/main/home/").get_json()
+    assert data["totalNotes"] == 1
+    assert data["totalChar"] == char_count - 2
+
+    result = client.application.test_cli_runner().invoke(args=["reconcile-counters"])
+    assert "total_note: 2" in result.output
+    data = client.get("/api-v1/main/home/").get_json()
+    assert data["totalNotes"] == 2
+
+
+# user profile loads the user and the note list in one query without note text
+def test_user_profile_query(client, db_session, test_note_1, test_user_2):
+    db_session.add_all([test_note_1, test_user_2])
+    db_session.commit()
+    note_id, username = test_note_1.id, test_user_2.username
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get(f"/api-v1/main/user-profile/{username}/")
+        assert response.status_code == 200
+        assert response.get_json() == {"notes": [], "nextCursor": None}
+
+        response = client.get("/api-v1/main/user-profile/test1/")
+        assert response.status_code == 200
+        assert [note["id"] for note in response.get_json()["notes"]] == [note_id]
+
+        response = client.get("/api-v1/main/user-profile/unknown/")
+        assert response.status_code == 404
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    assert len(statements) == 3
+    assert all("notes.text" not in statement for statement in statements)
+
+
+# cache hit serves the stored response body, the pin is kept outside of it
+def test_single_note_cached_body(client, db_session, redis_clean, test_note_1):
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    payload = {"username": "test1", "note_id": str(test_note_1.id), "pin": "pin"}
+    first = client.post("/api-v1/main/single-note/", json=payload)
+    second = client.post("/api-v1/main/single-note/", json=payload)
+    assert first.status_code == second.status_code == 200
+    assert first.data == second.data
+    assert second.mimetype == "application/json"
+
+    cached = redis_clean.get(RedisKeys.single_note(test_note_1.id))
+    assert cached == "\x00\x03pin" + first.data.decode()
+
+
+# large notes are cached compressed and sent compressed to gzip clients
+def test_single_note_gzip(client, db_session, test_note_1):
+    test_note_1.text = "large note text " * 1000
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    payload = {"username": "test1", "note_id": str(test_note_1.id), "pin": "pin"}
+    plain = client.post("/api-v1/main/single-note/", json=payload)
+    assert plain.status_code == 200
+    assert plain.content_encoding is None
+    assert plain.get_json()["text"] == test_note_1.text
+    assert "Accept-Encoding" in plain.vary
+
+    headers = {"Accept-Encoding": "gzip, deflate"}
+    compressed = client.post("/api-v1/main/single-note/", json=payload, headers=headers)
+    assert compressed.status_code == 200
+    assert compressed.content_encoding == "gzip"
+    assert len(compressed.data) < len(plain.data) / 10
+    assert gzip.decompress(compressed.data) == plain.data
+
+
+# unknown note ids and usernames are cached as missing for a short time
+def test_negative_cache(client, db_session, auth_headers_1):
+    note_id = (db_session.query(db.func.max(Notes.id)).scalar() or 0) + 1
+    payload = {"username": "test1", "note_id": str(note_id)}
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        for _ in range(3):
+            response = client.post("/api-v1/main/single-note/", json=payload)
+            assert response.status_code == 404
+            assert response.get_json()["error"] == "Note not found"
+
+            response = client.get("/api-v1/main/user-profile/unknown/")
+            assert response.status_code == 404
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    assert len(statements) == 2
+    assert 0 < redis_client.ttl(RedisKeys.single_note(note_id)) <= 33
+    generation = redis_client.get(RedisKeys.user_generation("unknown"))
+    assert 0 < redis_client.ttl(RedisKeys.user_notes("unknown", generation)) <= 33
+    # the generation counter of an unknown username expires too
+    ttl = redis_client.ttl(RedisKeys.user_generation("unknown"))
+    assert ttl > client.application.config["PROFILE_CACHE_TTL"]
+
+    # the next created note gets the cached id
+    response = client.post(
+        "/api-v1/notes/new-note/",
+        json={"title": "title", "text": "text", "pin": ""},
+        headers=auth_headers_1,
+    )
+    assert response.status_code == 201
+    assert response.get_json()["id"] == note_id
+    response = client.post("/api-v1/main/single-note/", json=payload)
+    assert response.status_code == 200
+
+    # register the missing username
+    redis_client.set(RedisKeys.sign_up("unknown@example.com"), "123456")
+    response = client.post(
+        "/api-v1/users/verify/",
+        json={
+            "username": "unknown",
+            "email": "unknown@example.com",
+            "password": "Asdf1111",
+            "otp": "123456",
+        },
+    )
+    assert response.status_code == 201
+    response = client.get("/api-v1/main/user-profile/unknown/")
+    assert response.status_code == 200
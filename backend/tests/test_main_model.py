@@ -34,10 +34,10 @@ class TestModel:
     # SingleNoteRequest
     def test_SingleNoteRequest_valid(self):
         validated = model.SingleNoteRequest(
-            username="validuser", note_id="note123", pin="1234"
+            username="validuser", note_id="123", pin="1234"
         )
         assert validated.username == "validuser"
-        assert validated.note_id == "note123"
+        assert validated.note_id == 123
         assert validated.pin == "1234"
 
     def test_SingleNoteRequest_username_too_short(self):
@@ -45,7 +45,7 @@ class TestModel:
         with pytest.raises(ValidationError) as exc_info:
             model.SingleNoteRequest(
                 username="t" * (MIN_NAME_LENGTH - 1),
-                note_id="note123",
+                note_id="123",
                 pin="1234",
             )
         assert f"String should have at least {MIN_NAME_LENGTH} characters" in str(
@@ -57,7 +57,7 @@ class TestModel:
         with pytest.raises(ValidationError) as exc_info:
             model.SingleNoteRequest(
                 username="t" * (MAX_NAME_LENGTH + 1),
-                note_id="note123",
+                note_id="123",
                 pin="1234",
             )
         assert f"String should have at most {MAX_NAME_LENGTH} characters" in str(
@@ -76,12 +76,19 @@ class TestModel:
             exc_info.value
         )
 
+    def test_SingleNoteRequest_note_id_normalized(self):
+        validated = model.SingleNoteRequest(username="validuser", note_id=" 007 ")
+        assert validated.note_id == 7
+        with pytest.raises(ValidationError) as exc_info:
+            model.SingleNoteRequest(username="validuser", note_id="note123")
+        assert "Note id must be a number." in str(exc_info.value)
+
     def test_SingleNoteRequest_pin_too_short(self):
         MIN_PIN_LENGTH = current_app.config["MIN_PIN_LENGTH"]
         with pytest.raises(ValidationError) as exc_info:
             model.SingleNoteRequest(
                 username="validuser",
-                note_id="note123",
+                note_id="123",
                 pin="t" * (MIN_PIN_LENGTH - 1),
             )
         assert f"String should have at least {MIN_PIN_LENGTH} characters" in str(
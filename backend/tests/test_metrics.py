@@ -0,0 +1,124 @@
+import os
+import sys
+import subprocess
+from prometheus_client import REGISTRY, CollectorRegistry, multiprocess
+from flaskapp.caching import LocalCache, RedisKeys
+
+
+METRICS_HEADERS = {"Authorization": "Bearer metrics-token"}
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_key_families():
+    assert RedisKeys.family(RedisKeys.single_note("1")) == "note"
+    assert RedisKeys.family(RedisKeys.user_notes("test1", 5)) == "user_notes"
+    assert RedisKeys.family(RedisKeys.user_generation("test1")) == "user_generation"
+    assert RedisKeys.family(RedisKeys.TOTAL_NOTE) == "totals"
+    assert RedisKeys.family(RedisKeys.sign_up("t@example.com")) == "otp"
+    assert RedisKeys.family(RedisKeys.reset_password("t@example.com")) == "otp"
+    assert RedisKeys.family(RedisKeys.principal(1)) == "principal"
+    assert RedisKeys.family(RedisKeys.lock("x")) == "other"
+
+
+def test_cache_metrics(client, db_session, redis_clean, test_note_1):
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    misses = sample("cache_misses_total", family="note")
+    local_hits = sample("cache_hits_total", family="note", layer="local")
+    requests = sample(
+        "http_request_duration_seconds_count",
+        endpoint="main.single_note",
+        method="POST",
+        status="200",
+    )
+
+    payload = {"username": "test1", "note_id": str(test_note_1.id), "pin": "pin"}
+    for _ in range(2):
+        response = client.post("/api-v1/main/single-note/", json=payload)
+        assert response.status_code == 200
+
+    assert sample("cache_misses_total", family="note") == misses + 1
+    assert sample("cache_hits_total", family="note", layer="local") == local_hits + 1
+    assert (
+        sample(
+            "http_request_duration_seconds_count",
+            endpoint="main.single_note",
+            method="POST",
+            status="200",
+        )
+        == requests + 2
+    )
+
+    response = client.get("/metrics", headers=METRICS_HEADERS)
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert b'cache_misses_total{family="note"}' in response.data
+    assert b"db_queries_total" in response.data
+
+
+def test_metrics_token(client, make_app):
+    response = client.get("/metrics")
+    assert response.status_code == 403
+    response = client.get("/metrics", headers={"Authorization": "Bearer wrong"})
+    assert response.status_code == 403
+
+    # not served at all without a configured token
+    flask_app = make_app(METRICS_TOKEN=None)
+    response = flask_app.test_client().get("/metrics", headers=METRICS_HEADERS)
+    assert response.status_code == 404
+
+
+def test_local_cache_evictions():
+    evictions = sample("cache_evictions_total", family="note")
+    cache = LocalCache(max_items=1, max_bytes=1024, ttl=60)
+    cache.set(RedisKeys.single_note("1"), b"a")
+    cache.set(RedisKeys.single_note("2"), b"b")
+    assert sample("cache_evictions_total", family="note") == evictions + 1
+
+
+# every gunicorn worker writes its own files, /metrics reports the sum
+def test_multiprocess_metrics(client, tmp_path, monkeypatch):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    worker = (
+        "from flaskapp.metrics import CACHE_HITS; "
+        "CACHE_HITS.labels('note', 'redis').inc(3)"
+    )
+    for _ in range(2):
+        subprocess.run(
+            [sys.executable, "-c", worker],
+            cwd=os.path.join(os.path.dirname(__file__), ".."),
+            check=True,
+        )
+
+    response = client.get("/metrics", headers=METRICS_HEADERS)
+    assert b'cache_hits_total{family="note",layer="redis"} 6.0' in response.data
+
+
+# the shipped gunicorn config switches prometheus_client to multiprocess
+# mode before the app is imported, samples of a worker reach any other
+def test_gunicorn_config_multiprocess(tmp_path):
+    worker = (
+        "import runpy; runpy.run_path('gunicorn.conf.py'); "
+        "from flaskapp.metrics import CACHE_HITS; "
+        "from prometheus_client import values; "
+        "assert values.ValueClass.__name__ == 'MmapedValue', values.ValueClass; "
+        "CACHE_HITS.labels('note', 'redis').inc(2)"
+    )
+    # unset, the config picks the directory under TMPDIR
+    env = {**os.environ, "TMPDIR": str(tmp_path)}
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    subprocess.run(
+        [sys.executable, "-c", worker],
+        cwd=os.path.join(os.path.dirname(__file__), ".."),
+        env=env,
+        check=True,
+    )
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=str(tmp_path / "prometheus"))
+    labels = {"family": "note", "layer": "redis"}
+    assert registry.get_sample_value("cache_hits_total", labels) == 2.0
@@ -1,3 +1,4 @@
+import redis
 from flaskapp.db_models import Notes
 
 
@@ -122,3 +123,95 @@ def test_update_note(client, db_session, test_note_1, auth_headers_1, auth_heade
     )
     assert response.status_code == 403
     assert response.get_json()["error"] == "Delete not allowed!"
+
+
+# edit note must not leave a stale note in the local cache
+def test_update_note_invalidates_cache(client, db_session, test_note_1, auth_headers_1):
+    db_session.add(test_note_1)
+    db_session.commit()
+
+    payload = {"username": "test1", "note_id": str(test_note_1.id), "pin": "pin"}
+    response = client.post("/api-v1/main/single-note/", json=payload)
+    assert response.get_json()["title"] == test_note_1.title
+
+    update = {"title": "New title", "text": "New text", "pin": "pin"}
+    update["note_id"] = test_note_1.id
+    response = client.put(
+        "/api-v1/notes/update-note/", json=update, headers=auth_headers_1
+    )
+    assert response.status_code == 200
+
+    response = client.post("/api-v1/main/single-note/", json=payload)
+    assert response.get_json()["title"] == "New title"
+
+
+# keyset pagination of logged in user notes
+def test_note_list_cursor(client, db_session, test_user_1, auth_headers_1):
+    for i in range(1, 15):
+        note = Notes(title=f"Note title {i}", text="text", user_id=test_user_1.id)
+        db_session.add(note)
+    db_session.commit()
+
+    note_ids = []
+    after = ""
+    while after is not None:
+        response = client.get(f"/api-v1/notes/?after={after}", headers=auth_headers_1)
+        assert response.status_code == 200
+
+        data = response.get_json()
+        assert "pagination" not in data
+        assert len(data["notes"]) <= 6
+        note_ids.extend(note["id"] for note in data["notes"])
+        after = data["nextCursor"]
+
+    # every note exactly once, newest first
+    assert len(note_ids) == 14
+    assert note_ids == sorted(note_ids, reverse=True)
+
+    response = client.get("/api-v1/notes/?after=invalid", headers=auth_headers_1)
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Invalid cursor"
+
+
+# invalidation and counters of a write go to redis in one pipeline
+def test_note_writes_one_round_trip(client, db_session, auth_headers_1, monkeypatch):
+    calls = []
+    execute_command = redis.Redis.execute_command
+    execute = redis.client.Pipeline.execute
+
+    def count_command(self, *args, **kwargs):
+        calls.append(args[0])
+        return execute_command(self, *args, **kwargs)
+
+    def count_pipeline(self, *args, **kwargs):
+        calls.append([command[0][0] for command in self.command_stack])
+        return execute(self, *args, **kwargs)
+
+    # warm up the cached principal
+    client.get("/api-v1/notes/", headers=auth_headers_1)
+    monkeypatch.setattr(redis.Redis, "execute_command", count_command)
+    monkeypatch.setattr(redis.client.Pipeline, "execute", count_pipeline)
+
+    payload = {"title": "title", "text": "text", "pin": ""}
+    response = client.post(
+        "/api-v1/notes/new-note/", json=payload, headers=auth_headers_1
+    )
+    assert response.status_code == 201
+    note_id = response.get_json()["id"]
+    assert calls == [["UNLINK", "EVAL", "PUBLISH", "EVAL"]]
+
+    calls.clear()
+    payload["note_id"] = note_id
+    response = client.put(
+        "/api-v1/notes/update-note/", json=payload, headers=auth_headers_1
+    )
+    assert response.status_code == 200
+    assert calls == [["UNLINK", "EVAL", "PUBLISH", "EVAL"]]
+
+    calls.clear()
+    response = client.delete(
+        f"/api-v1/notes/delete-note/{note_id}/", headers=auth_headers_1
+    )
+    assert response.status_code == 200
+    assert calls == [["UNLINK", "EVAL", "PUBLISH", "EVAL"]]
+
@@ -0,0 +1,80 @@
+import jwt
+import pytest
+import datetime
+from sqlalchemy import select
+from flaskapp import db
+from flaskapp.caching import RedisKeys, redis_client
+from flaskapp.db_models import Notes
+from flaskapp.replica import REPLICA_BIND, ReplicaLag, replica_lag
+from tests.conftest import seed
+
+
+@pytest.fixture()
+def replica_app(make_app, tmp_path, redis_clean):
+    """Primary and replica on two sqlite files, replication is done by hand."""
+    flask_app = make_app(
+        SQLALCHEMY_BINDS={REPLICA_BIND: f"sqlite:///{tmp_path / 'replica.db'}"}
+    )
+    with flask_app.app_context():
+        seed(db.engine, title="primary")
+        seed(db.engines[REPLICA_BIND], title="replica")
+
+        replica_lag.checked_at = 0.0
+        yield flask_app
+        replica_lag.checked_at = 0.0
+
+
+def read_title(client) -> str:
+    payload = {"username": "test1", "note_id": "1"}
+    response = client.post("/api-v1/main/single-note/", json=payload)
+    assert response.status_code == 200
+    return response.get_json()["title"]
+
+
+def test_reads_from_replica(replica_app):
+    client = replica_app.test_client()
+    assert read_title(client) == "replica"
+
+    response = client.get("/api-v1/main/user-profile/test1/")
+    assert response.get_json()["notes"][0]["title"] == "replica"
+
+    # a replica read may be behind a write, it is not cached for long
+    assert 0 < redis_client.ttl(RedisKeys.single_note("1")) <= 33
+    generation = redis_client.get(RedisKeys.user_generation("test1"))
+    assert 0 < redis_client.ttl(RedisKeys.user_notes("test1", generation)) <= 33
+
+
+def test_primary_reads_cached_without_ttl(replica_app, monkeypatch):
+    monkeypatch.setattr(ReplicaLag, "measure", staticmethod(lambda engine: 60.0))
+    assert read_title(replica_app.test_client()) == "primary"
+    assert redis_client.ttl(RedisKeys.single_note("1")) == -1
+
+
+def test_primary_on_replica_lag(replica_app, monkeypatch):
+    monkeypatch.setattr(ReplicaLag, "measure", staticmethod(lambda engine: 60.0))
+    assert read_title(replica_app.test_client()) == "primary"
+
+
+def test_read_your_writes(replica_app):
+    client = replica_app.test_client()
+    token = jwt.encode(
+        {"id": 1, "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=5)},
+        replica_app.config["SECRET_KEY"],
+        algorithm="HS256",
+    )
+    headers = {"Authorization": f"basic {token}"}
+
+    payload = {"note_id": 1, "title": "edited", "text": "text", "pin": ""}
+    response = client.put("/api-v1/notes/update-note/", json=payload, headers=headers)
+    assert response.status_code == 200
+
+    # the write went to the primary only
+    with db.engines[REPLICA_BIND].connect() as connection:
+        assert connection.execute(select(Notes.title)).scalar() == "replica"
+
+    # the author reads the edit from the primary until the replica caught up
+    assert redis_client.ttl(RedisKeys.sticky_note(1)) > 0
+    assert redis_client.ttl(RedisKeys.sticky_user("test1")) > 0
+    assert read_title(client) == "edited"
+    response = client.get("/api-v1/main/user-profile/test1/")
+    assert response.get_json()["notes"][0]["title"] == "edited"
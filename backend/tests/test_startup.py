@@ -0,0 +1,47 @@
+import os
+import sys
+import subprocess
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..")
+
+# generous for slow CI machines, a fresh worker takes well under a second
+STARTUP_BUDGET = 2.0  # seconds
+
+CREATE_APP = """
+import sys, time
+start = time.perf_counter()
+from flaskapp import create_app
+from flaskapp.config import ProductionConfig
+create_app(ProductionConfig)
+print(time.perf_counter() - start)
+print(",".join(sys.modules))
+"""
+
+
+def test_cold_start(tmp_path):
+    database_uri = f"sqlite:///{tmp_path / 'app.db'}"
+    env = {**os.environ, "SQLALCHEMY_DATABASE_URI": database_uri}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CREATE_APP],
+        cwd=BACKEND_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed, modules = result.stdout.splitlines()[-2:]
+    modules = set(modules.split(","))
+
+    # only the `flask db` commands need alembic
+    assert "flask_migrate" not in modules
+    assert "alembic" not in modules
+
+    # "import time: self | cumulative | module", nested modules are indented
+    rows = [
+        line.split("|")
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:") and "[us]" not in line
+    ]
+    top_level = [row for row in rows if not row[2].startswith("  ")]
+    slowest = sorted(top_level, key=lambda row: -int(row[1]))[:5]
+    assert float(elapsed) < STARTUP_BUDGET, slowest
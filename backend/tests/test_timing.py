@@ -0,0 +1,41 @@
+from prometheus_client import REGISTRY
+
+
+def server_timing(response) -> dict:
+    phases = {}
+    for metric in response.headers["Server-Timing"].split(", "):
+        name, duration = metric.split(";dur=")
+        phases[name] = float(duration)
+    return phases
+
+
+def phase_count(endpoint: str, name: str) -> float:
+    labels = {"endpoint": endpoint, "phase": name}
+    return REGISTRY.get_sample_value("request_phase_seconds_count", labels) or 0.0
+
+
+def test_server_timing(timed_app):
+    client = timed_app.test_client()
+    payload = {"username": "test1", "note_id": "1"}
+    db_count = phase_count("main.single_note", "db")
+
+    response = client.post("/api-v1/main/single-note/", json=payload)
+    assert response.status_code == 200
+    phases = server_timing(response)
+    assert {"validate", "redis", "db", "serialize", "total"} <= phases.keys()
+    assert phases["total"] >= phases["db"]
+    assert phase_count("main.single_note", "db") == db_count + 1
+
+    # served from the cache, no database phase
+    response = client.post("/api-v1/main/single-note/", json=payload)
+    assert "db" not in server_timing(response)
+
+    # errors are timed too
+    response = client.get("/api-v1/main/user-profile/nobody/")
+    assert response.status_code == 404
+    assert "total" in server_timing(response)
+
+
+def test_timing_disabled(client):
+    response = client.get("/api-v1/main/user-profile/nobody/")
+    assert "Server-Timing" not in response.headers
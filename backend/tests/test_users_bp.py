@@ -1,4 +1,11 @@
-from flaskapp import db
+import os
+import time
+import signal
+import threading
+from flaskapp import db, hasher
+from flaskapp.db_models import User
+from flaskapp.exceptions import ServiceUnavailableError
+from flaskapp.hashing import _hash_password, hash_rounds
 from flaskapp.caching import RedisKeys, redis_client
 
 
@@ -132,6 +139,73 @@ def test_reset_password_error(client, test_user_1):
     )
     assert response.status_code == 404
     assert response.get_json()["error"] == "User not found!"
+    # the reservation is released
+    assert redis_client.get(otp_key) is None
+
+
+def test_otp_rate_limits(client, monkeypatch):
+    monkeypatch.setitem(client.application.config, "OTP_MAX_PER_EMAIL", 2)
+    monkeypatch.setitem(client.application.config, "OTP_MAX_PER_IP", 3)
+    payload = {"username": "new_name", "email": "new@example.com"}
+
+    for _ in range(2):
+        response = client.post("/api-v1/users/sign-up/", json=payload)
+        assert response.status_code == 200
+        redis_client.delete(RedisKeys.sign_up(payload["email"]))
+
+    # per email window is full, nothing is stored or queued
+    response = client.post("/api-v1/users/sign-up/", json=payload)
+    assert response.status_code == 429
+    assert (
+        response.get_json()["error"] == "Too many OTP requests, please try again later"
+    )
+    assert redis_client.get(RedisKeys.sign_up(payload["email"])) is None
+    assert redis_client.llen(RedisKeys.MAIL_QUEUE) == 2
+
+    # per ip window
+    payload = {"username": "other", "email": "other@example.com"}
+    response = client.post("/api-v1/users/sign-up/", json=payload)
+    assert response.status_code == 200
+    redis_client.delete(RedisKeys.sign_up(payload["email"]))
+    response = client.post("/api-v1/users/sign-up/", json=payload)
+    assert response.status_code == 429
+
+
+def test_otp_ip_limit_behind_proxy(client, redis_clean, monkeypatch):
+    monkeypatch.setitem(client.application.config, "OTP_MAX_PER_IP", 1)
+
+    def sign_up(email, forwarded_for):
+        payload = {"username": email.split("@")[0], "email": email}
+        return client.post(
+            "/api-v1/users/sign-up/",
+            json=payload,
+            headers={"X-Forwarded-For": forwarded_for},
+            environ_base={"REMOTE_ADDR": "10.0.0.10"},
+        )
+
+    assert sign_up("first@example.com", "203.0.113.1").status_code == 200
+    assert sign_up("second@example.com", "203.0.113.1").status_code == 429
+    # another client of the same proxy has its own window
+    assert sign_up("third@example.com", "203.0.113.2").status_code == 200
+
+
+def test_otp_concurrent_requests_send_once(app, db_session, redis_clean):
+    payload = {"username": "new_name", "email": "new@example.com"}
+    statuses = []
+
+    def sign_up():
+        with app.test_client() as client:
+            response = client.post("/api-v1/users/sign-up/", json=payload)
+            statuses.append(response.status_code)
+
+    threads = [threading.Thread(target=sign_up) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(statuses) == [200, 429, 429, 429, 429]
+    assert redis_client.llen(RedisKeys.MAIL_QUEUE) == 1
 
 
 # test verify reset otp endpoint
@@ -185,3 +259,72 @@ def test_account(client, auth_headers_1, test_user_1):
     data = response.get_json()
     assert data["name"] == test_user_1.username
     assert data["email"] == test_user_1.email
+
+
+def test_log_in_rehash(client, db_session, test_user_1):
+    # stored with an older cost factor than BCRYPT_LOG_ROUNDS
+    test_user_1.password = _hash_password("string", 5)
+    db_session.add(test_user_1)
+    db_session.commit()
+
+    payload = {"email": test_user_1.email, "password": "string"}
+    response = client.post("/api-v1/users/log-in/", json=payload)
+    assert response.status_code == 200
+
+    user = db_session.get(User, test_user_1.id)
+    assert hash_rounds(user.password) == 4
+    assert hasher.check_password_hash(user.password, "string")
+
+
+def test_hashing_pool_recovers_from_killed_process(app):
+    pool = hasher._get_pool()
+    pw_hash = hasher.generate_password_hash("string")
+
+    os.kill(next(iter(pool._processes)), signal.SIGKILL)
+    deadline = time.monotonic() + 5
+    while not pool._broken and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pool._broken
+
+    # a new pool replaces the broken one
+    assert hasher.check_password_hash(pw_hash, "string")
+    assert hasher._pool is not pool
+
+
+def test_hashing_timeout_frees_slot(app, monkeypatch):
+    monkeypatch.setattr(hasher, "_pending", threading.BoundedSemaphore(2))
+    monkeypatch.setattr(hasher, "timeout", 0.05)
+    # the first hash runs, the second one is still queued when it times out
+    monkeypatch.setattr(hasher, "rounds", 12)
+    errors = []
+
+    def generate():
+        try:
+            hasher.generate_password_hash("string")
+        except ServiceUnavailableError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=generate) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 2
+    # both slots are free again right away, not once the hashes finish
+    assert hasher._pending.acquire(blocking=False)
+    assert hasher._pending.acquire(blocking=False)
+
+
+def test_log_in_hashing_queue_full(client, db_session, test_user_1, monkeypatch):
+    db_session.add(test_user_1)
+    db_session.commit()
+
+    # no free slot in the hashing queue
+    monkeypatch.setattr(hasher, "_pending", threading.BoundedSemaphore(1))
+    hasher._pending.acquire()
+
+    payload = {"email": test_user_1.email, "password": "string"}
+    response = client.post("/api-v1/users/log-in/", json=payload)
+    assert response.status_code == 503
+    assert response.get_json()["error"] == "Server is busy, please try again later"
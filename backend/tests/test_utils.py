@@ -2,6 +2,9 @@ import jwt
 import time
 import datetime
 from flask import current_app
+from sqlalchemy import event
+from flaskapp import db
+from flaskapp.caching import RedisKeys, redis_client
 
 
 # test logout_required decorator from signup route
@@ -77,3 +80,111 @@ def test_login_required(client, monkeypatch):
 
     assert response.status_code == 500
     assert response.get_json().get("error") == "An unexpected error occurred"
+
+
+# authenticated requests reuse the cached claims and user record
+def test_login_required_cache(client, auth_headers_1, test_user_1, monkeypatch):
+    response = client.get("/api-v1/users/account/", headers=auth_headers_1)
+    assert response.status_code == 200
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    def fail_jwt_decode(*args, **kwargs):
+        raise AssertionError("token decoded again")
+
+    monkeypatch.setattr("flaskapp.utils.jwt.decode", fail_jwt_decode)
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get("/api-v1/users/account/", headers=auth_headers_1)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+    assert response.status_code == 200
+    assert response.get_json()["name"] == test_user_1.username
+    assert statements == []
+
+    # password change drops the cached user record
+    principal_key = RedisKeys.principal(test_user_1.id)
+    assert redis_client.exists(principal_key)
+    redis_client.set(RedisKeys.reset_password(test_user_1.email), "123456")
+    payload = {"email": test_user_1.email, "password": "Asdf1111", "otp": "123456"}
+    response = client.post("/api-v1/users/new-password/", json=payload)
+    assert response.status_code == 200
+    assert not redis_client.exists(principal_key)
+
+
+# a signed token without an expiry is accepted but its claims are not cached
+def test_login_required_token_without_exp(client, db_session, test_user_1):
+    from flaskapp.utils import token_cache
+
+    db_session.add(test_user_1)
+    db_session.commit()
+    token = jwt.encode(
+        {"id": test_user_1.id}, current_app.config["SECRET_KEY"], algorithm="HS256"
+    )
+    headers = {"Authorization": f"basic {token}"}
+    for _ in range(2):
+        response = client.get("/api-v1/users/account/", headers=headers)
+        assert response.status_code == 200
+    assert token_cache.size == 0
+
+
+def test_rate_limit(client, monkeypatch):
+    monkeypatch.setitem(client.application.config["RATE_LIMITS"], "log-in", (2, 0.5))
+    payload = {"email": "test1@example.com", "password": "invalid"}
+
+    for _ in range(2):
+        response = client.post("/api-v1/users/log-in/", json=payload)
+        assert response.status_code == 404
+
+    # bucket is empty, the request never reaches the handler
+    response = client.post("/api-v1/users/log-in/", json=payload)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    assert response.get_json()["error"] == "Too many requests, please try again later"
+
+    # other clients have their own bucket
+    response = client.post(
+        "/api-v1/users/log-in/",
+        json=payload,
+        environ_base={"REMOTE_ADDR": "10.0.0.2"},
+    )
+    assert response.status_code == 404
+
+    # one second later half a token is refilled to the one left
+    key = RedisKeys.rate_limit("log-in", "127.0.0.1")
+    last_refill = int(redis_client.hget(key, "ts"))
+    redis_client.hset(key, mapping={"tokens": 0.5, "ts": last_refill - 1000})
+    response = client.post("/api-v1/users/log-in/", json=payload)
+    assert response.status_code == 404
+
+
+# clients behind the nginx proxy share its address, X-Forwarded-For tells them apart
+def test_rate_limit_behind_proxy(client, redis_clean, monkeypatch):
+    monkeypatch.setitem(client.application.config["RATE_LIMITS"], "log-in", (1, 0.01))
+    payload = {"email": "test1@example.com", "password": "invalid"}
+
+    def log_in(forwarded_for):
+        return client.post(
+            "/api-v1/users/log-in/",
+            json=payload,
+            headers={"X-Forwarded-For": forwarded_for},
+            environ_base={"REMOTE_ADDR": "10.0.0.10"},
+        )
+
+    assert log_in("203.0.113.1").status_code == 404
+    assert log_in("203.0.113.1").status_code == 429
+    assert log_in("203.0.113.2").status_code == 404
+
+    # only the address appended by the trusted proxy counts, not a spoofed one
+    assert log_in("198.51.100.7, 203.0.113.1").status_code == 429
+    assert redis_client.exists(RedisKeys.rate_limit("log-in", "203.0.113.2"))
+    assert not redis_client.exists(RedisKeys.rate_limit("log-in", "10.0.0.10"))
+
+    # reached directly, the header is not trusted
+    monkeypatch.setitem(client.application.config, "PROXY_TRUSTED_HOPS", 0)
+    assert log_in("203.0.113.3").status_code == 404
+    assert log_in("203.0.113.4").status_code == 429